@@ -0,0 +1,293 @@
+# ---- ТОРГОВА АНАЛІТИКА ----
+# Чисті векторизовані (NumPy/pandas) функції без залежності від Streamlit, щоб їх можна було
+# імпортувати, тестувати та бенчмаркати окремо від UI (див. benchmarks/bench_analytics.py).
+import numpy as np
+import pandas as pd
+
+PROFIT_COLUMN = "net_profit_db"
+BALANCE_COLUMN = "change_balance_acc"
+TIME_CLOSE_COLUMN = "time_close"
+
+# Як була впорядкована вісь X після очистки
+TIME_KIND_DATETIME = "datetime"
+TIME_KIND_NUMERIC = "numeric"
+TIME_KIND_INDEX = "index"
+
+
+def parse_close_times(time_close: pd.Series) -> pd.Series | None:
+    """time_close -> datetime64. Числові значення трактуються як epoch-секунди.
+
+    Повертає None, якщо жодне значення не вдалося розпізнати як дату/час.
+    """
+    if pd.api.types.is_datetime64_any_dtype(time_close):
+        parsed = time_close
+    elif pd.api.types.is_numeric_dtype(time_close):
+        parsed = pd.to_datetime(time_close, unit='s', origin='unix', errors='coerce')
+    else:
+        parsed = pd.to_datetime(time_close, errors='coerce')
+        if parsed.isna().all():
+            parsed = pd.to_datetime(pd.to_numeric(time_close, errors='coerce'), unit='s', origin='unix', errors='coerce')
+    return None if parsed.isna().all() else parsed
+
+
+def clean_trades(positions_df: pd.DataFrame) -> tuple[pd.DataFrame, str]:
+    """Вузький очищений фрейм угод для графіків та метрик.
+
+    Колонки прибутку та балансу приводяться до float, time_close - до дати (time_close_dt)
+    або, якщо це не вдається, до числа (time_close_numeric). Рядки з пропусками відкидаються,
+    результат відсортований за часом закриття. cumulative_profit рахується заново по цих рядках:
+    значення з вхідного фрейму могли бути пораховані в іншому порядку чи з відкинутими рядками.
+    Другим значенням повертається TIME_KIND_*.
+    """
+    cleaned_df = pd.DataFrame({
+        PROFIT_COLUMN: pd.to_numeric(positions_df[PROFIT_COLUMN], errors='coerce'),
+        BALANCE_COLUMN: pd.to_numeric(positions_df[BALANCE_COLUMN], errors='coerce'),
+    }, index=positions_df.index)
+
+    value_columns = [PROFIT_COLUMN, BALANCE_COLUMN]
+    time_kind = TIME_KIND_INDEX
+    if TIME_CLOSE_COLUMN in positions_df.columns:
+        close_times = parse_close_times(positions_df[TIME_CLOSE_COLUMN])
+        if close_times is not None:
+            time_column, time_kind = 'time_close_dt', TIME_KIND_DATETIME
+            cleaned_df[time_column] = close_times
+        else:
+            time_column, time_kind = 'time_close_numeric', TIME_KIND_NUMERIC
+            cleaned_df[time_column] = pd.to_numeric(positions_df[TIME_CLOSE_COLUMN], errors='coerce')
+
+        sorted_df = cleaned_df.dropna(subset=value_columns + [time_column])
+        if cleaned_df[time_column].notna().any() and not sorted_df.empty:
+            cleaned_df = sorted_df.sort_values(by=time_column, kind='stable')
+        else:
+            cleaned_df, time_kind = cleaned_df.drop(columns=[time_column]), TIME_KIND_INDEX
+
+    if time_kind == TIME_KIND_INDEX:
+        cleaned_df = cleaned_df.dropna(subset=value_columns)
+    cleaned_df['cumulative_profit'] = equity_curve(cleaned_df[PROFIT_COLUMN])
+    return cleaned_df, time_kind
+
+
+def merge_trades_delta(cached_df: pd.DataFrame, delta_df: pd.DataFrame, watermark_column: str, watermark,
+                       append=None) -> pd.DataFrame:
+    """Кеш угод + дельта, завантажена з умовою watermark_column >= watermark.
+
+    З кешу лишаються рядки з watermark_column < watermark та рядки без watermark (NULL): дельта-запит
+    їх не повертає, а їхній профіт вже врахований у cumulative_profit кешу. Граничні рядки (== watermark)
+    беруться з дельти. Кумулятивний профіт дельти продовжує останнє значення з кешу.
+    append(kept_df, delta_df) -> DataFrame замінює звичайний pd.concat (напр. щоб зберегти компактні типи).
+    """
+    watermark_values = cached_df[watermark_column]
+    kept_mask = watermark_values.isna().to_numpy(copy=True)
+    # Порівнюємо лише заповнені значення: None в object-колонці з рядком не порівнюється
+    kept_mask[~kept_mask] = (watermark_values[~kept_mask] < watermark).to_numpy(dtype=bool)
+    kept_df = cached_df[kept_mask]
+
+    delta_df = delta_df.reset_index(drop=True)
+    if PROFIT_COLUMN in delta_df.columns:
+        offset = float(kept_df['cumulative_profit'].iloc[-1]) if 'cumulative_profit' in kept_df.columns and not kept_df.empty else 0.0
+        delta_df['cumulative_profit'] = equity_curve(pd.to_numeric(delta_df[PROFIT_COLUMN], errors='coerce'), initial=offset)
+    if append is None:
+        return pd.concat([kept_df, delta_df], ignore_index=True)
+    return append(kept_df, delta_df)
+
+
+def equity_curve(profits, initial: float = 0.0) -> np.ndarray:
+    """Кумулятивний профіт; пропуски (NaN) вважаються нульовим результатом угоди."""
+    return np.cumsum(np.nan_to_num(np.asarray(profits, dtype='float64'))) + initial
+
+
+def running_max_drawdown(equity, initial: float = 0.0) -> np.ndarray:
+    """Поточна просадка від піку кривої капіталу (пік не нижчий за стартове значення initial)."""
+    equity = np.asarray(equity, dtype='float64')
+    peaks = np.maximum(np.maximum.accumulate(equity), initial) if len(equity) else equity
+    return peaks - equity
+
+
+def max_drawdown(equity, initial: float = 0.0) -> float:
+    drawdowns = running_max_drawdown(equity, initial)
+    return float(drawdowns.max()) if len(drawdowns) else 0.0
+
+
+def rolling_win_rate(profits, window: int) -> np.ndarray:
+    """Частка прибуткових угод серед останніх window угод (на початку - серед усіх наявних)."""
+    profits = np.asarray(profits, dtype='float64')
+    n_trades = len(profits)
+    wins_cumulative = np.concatenate(([0], np.cumsum(profits > 0)))
+    ends = np.arange(1, n_trades + 1)
+    starts = np.maximum(ends - window, 0)
+    return (wins_cumulative[ends] - wins_cumulative[starts]) / (ends - starts)
+
+
+def win_rate(profits) -> float:
+    profits = np.asarray(profits, dtype='float64')
+    return float(np.mean(profits > 0)) if len(profits) else float('nan')
+
+
+def profit_factor(profits) -> float:
+    """Валовий прибуток / валовий збиток; inf, якщо збиткових угод немає."""
+    profits = np.asarray(profits, dtype='float64')
+    gross_profit = profits[profits > 0].sum()
+    gross_loss = -profits[profits < 0].sum()
+    if gross_loss == 0:
+        return float('inf') if gross_profit > 0 else float('nan')
+    return float(gross_profit / gross_loss)
+
+
+def trade_returns(profits, balances_after) -> np.ndarray:
+    """Дохідність угоди відносно балансу перед нею (баланс після угоди мінус її результат)."""
+    profits = np.asarray(profits, dtype='float64')
+    balances_before = np.asarray(balances_after, dtype='float64') - profits
+    with np.errstate(divide='ignore', invalid='ignore'):
+        returns = profits / balances_before
+    return np.where(balances_before > 0, returns, np.nan)
+
+
+def sharpe_ratio(returns, periods_per_year: float = 252.0, risk_free: float = 0.0) -> float:
+    returns = np.asarray(returns, dtype='float64')
+    returns = returns[~np.isnan(returns)] - risk_free
+    if len(returns) < 2:
+        return float('nan')
+    std = returns.std(ddof=1)
+    return float(returns.mean() / std * np.sqrt(periods_per_year)) if std > 0 else float('nan')
+
+
+def sortino_ratio(returns, periods_per_year: float = 252.0, risk_free: float = 0.0) -> float:
+    returns = np.asarray(returns, dtype='float64')
+    returns = returns[~np.isnan(returns)] - risk_free
+    if len(returns) < 2:
+        return float('nan')
+    downside_deviation = np.sqrt(np.mean(np.minimum(returns, 0.0) ** 2))
+    return float(returns.mean() / downside_deviation * np.sqrt(periods_per_year)) if downside_deviation > 0 else float('nan')
+
+
+def min_max_downsample_indices(values, n_buckets: int) -> np.ndarray:
+    """Індекси точок, що лишаються після downsampling (first/min/max/last у кожному бакеті).
+
+    На відміну від рівномірного проріджування, зберігає всі локальні екстремуми бакетів,
+    тому піки та дна (а отже і максимальна просадка) на графіку точні.
+    """
+    values = np.asarray(values, dtype='float64')
+    n_points = len(values)
+    if n_buckets <= 0 or n_points <= 4 * n_buckets:
+        return np.arange(n_points)
+
+    bucket_size = -(-n_points // n_buckets)
+    n_buckets = -(-n_points // bucket_size)
+    padded = np.full(n_buckets * bucket_size, np.nan)
+    padded[:n_points] = values
+    buckets = padded.reshape(n_buckets, bucket_size)
+    # NaN у середині ряду не повинні "з'їдати" бакет: для argmin/argmax замінюємо їх на +/-inf
+    bucket_min_idx = np.argmin(np.where(np.isnan(buckets), np.inf, buckets), axis=1)
+    bucket_max_idx = np.argmax(np.where(np.isnan(buckets), -np.inf, buckets), axis=1)
+
+    bucket_starts = np.arange(n_buckets) * bucket_size
+    bucket_ends = np.minimum(bucket_starts + bucket_size, n_points) - 1
+    indices = np.concatenate([bucket_starts, bucket_starts + bucket_min_idx, bucket_starts + bucket_max_idx, bucket_ends])
+    return np.unique(np.minimum(indices, n_points - 1))
+
+
+def resample_last_value(times, values, grid) -> np.ndarray:
+    """Значення ступінчастого ряду (напр. кривої капіталу) в точках сітки grid.
+
+    times має бути відсортований; у кожній точці сітки береться останнє відоме значення,
+    до першої точки ряду - NaN. times та grid - у тих самих одиницях (напр. int64 наносекунди).
+    """
+    times = np.asarray(times)
+    values = np.asarray(values, dtype='float64')
+    grid = np.asarray(grid)
+    if len(values) == 0:
+        return np.full(len(grid), np.nan)
+    positions = np.searchsorted(times, grid, side='right') - 1
+    resampled = values[np.maximum(positions, 0)]
+    resampled[positions < 0] = np.nan
+    return resampled
+
+
+# Рівні агрегації угод для графіків, від найдрібнішого до найгрубшого: ширина бакета в наносекундах
+NS_PER_HOUR = 3_600 * 10**9
+ROLLUP_RESOLUTIONS = {
+    "hour": NS_PER_HOUR,
+    "day": 24 * NS_PER_HOUR,
+    "week": 7 * 24 * NS_PER_HOUR,
+}
+# Початок відліку бакетів: тижні - з понеділка (1970-01-05), решта - з epoch
+ROLLUP_ORIGINS_NS = {"week": 4 * 24 * NS_PER_HOUR}
+
+
+def bucket_floor(times_ns, resolution: str) -> np.ndarray:
+    """Початок бакета resolution для кожного моменту часу (int64 наносекунди)."""
+    width_ns = ROLLUP_RESOLUTIONS[resolution]
+    origin_ns = ROLLUP_ORIGINS_NS.get(resolution, 0)
+    return (np.asarray(times_ns, dtype='int64') - origin_ns) // width_ns * width_ns + origin_ns
+
+
+def rollup_trades(times_ns, profits, balances, equity, resolution: str) -> pd.DataFrame:
+    """Агрегати угод по бакетах часу: сума P&L, кількість угод, баланс та капітал на закритті бакета, min/max капіталу.
+
+    times_ns має бути відсортований (int64 наносекунди); бакети без угод у результат не потрапляють.
+    """
+    times_ns = np.asarray(times_ns, dtype='int64')
+    profits = np.nan_to_num(np.asarray(profits, dtype='float64'))
+    balances = np.asarray(balances, dtype='float64')
+    equity = np.asarray(equity, dtype='float64')
+    buckets = bucket_floor(times_ns, resolution)
+    if len(times_ns) == 0:
+        starts = ends = np.array([], dtype='int64')
+        pnl, equity_min, equity_max = profits, equity, equity
+    else:
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(buckets)) + 1))
+        ends = np.append(starts[1:], len(times_ns)) - 1
+        # fmin/fmax пропускають NaN
+        pnl, equity_min, equity_max = (np.add.reduceat(profits, starts), np.fmin.reduceat(equity, starts),
+                                       np.fmax.reduceat(equity, starts))
+    return pd.DataFrame({
+        "bucket_start": pd.to_datetime(buckets[starts], unit='ns'),
+        "pnl": pnl,
+        "trade_count": ends - starts + 1,
+        "balance_close": balances[ends],
+        "equity_close": equity[ends],
+        "equity_min": equity_min,
+        "equity_max": equity_max,
+    })
+
+
+def extend_rollup(rollup: pd.DataFrame, times_ns, profits, balances, equity, resolution: str, changed_from_ns: int) -> pd.DataFrame:
+    """Оновлення агрегатів після догрузки угод з часом >= changed_from_ns.
+
+    Бакети до бакета, що містить changed_from_ns, не змінились і беруться з rollup; решта
+    перераховується з угод (times_ns та ін. - вже об'єднаний відсортований ряд усіх угод).
+    """
+    cut_ns = int(bucket_floor([changed_from_ns], resolution)[0])
+    bucket_starts_ns = rollup_bucket_starts_ns(rollup)
+    kept = rollup.iloc[:np.searchsorted(bucket_starts_ns, cut_ns, side='left')]
+    times_ns = np.asarray(times_ns, dtype='int64')
+    first_changed = int(np.searchsorted(times_ns, cut_ns, side='left'))
+    fresh = rollup_trades(
+        times_ns[first_changed:], np.asarray(profits)[first_changed:], np.asarray(balances)[first_changed:],
+        np.asarray(equity)[first_changed:], resolution
+    )
+    return pd.concat([kept, fresh], ignore_index=True)
+
+
+def rollup_bucket_starts_ns(rollup: pd.DataFrame) -> np.ndarray:
+    return pd.DatetimeIndex(rollup["bucket_start"]).as_unit('ns').asi8
+
+
+def choose_rollup_resolution(trade_times_ns, rollups: dict, start_ns: int, end_ns: int, max_points: int) -> tuple:
+    """(рівень, кількість точок у вікні [start_ns, end_ns]) для графіка шириною max_points.
+
+    Рівень None - сирі угоди: вони беруться, поки їх у вікні не більше max_points. Інакше - найдрібніший
+    рівень агрегації, що вміщається у max_points, а якщо не вміщається жоден - найгрубший.
+    """
+    trade_times_ns = np.asarray(trade_times_ns, dtype='int64')
+    n_trades = int(np.searchsorted(trade_times_ns, end_ns, side='right') - np.searchsorted(trade_times_ns, start_ns, side='left'))
+    if n_trades <= max_points:
+        return None, n_trades
+    for resolution in ROLLUP_RESOLUTIONS:
+        bucket_starts_ns = rollup_bucket_starts_ns(rollups[resolution])
+        first_bucket_ns = int(bucket_floor([start_ns], resolution)[0])
+        n_buckets = int(np.searchsorted(bucket_starts_ns, end_ns, side='right')
+                        - np.searchsorted(bucket_starts_ns, first_bucket_ns, side='left'))
+        if n_buckets <= max_points:
+            return resolution, n_buckets
+    return resolution, n_buckets
@@ -0,0 +1,102 @@
+# ---- БЕНЧМАРК АНАЛІТИКИ ----
+# Генерує синтетичні таблиці у форматі `{account_id}_mt5_data` різного розміру та міряє
+# час і піковий обсяг пам'яті для кожного етапу analytics.py.
+#
+# Запуск з кореня репозиторію:
+#     python benchmarks/bench_analytics.py                      # 1e4 .. 1e7 рядків
+#     python benchmarks/bench_analytics.py --sizes 10000 100000 --json bench_output.json
+import argparse
+import json
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import analytics  # noqa: E402
+
+DEFAULT_SIZES = (10_000, 100_000, 1_000_000, 10_000_000)
+DOWNSAMPLE_BUCKETS = 1200
+ROLLING_WINDOW = 100
+
+
+def make_positions_table(n_rows: int, seed: int = 0, epoch_time_close: bool = True) -> pd.DataFrame:
+    """Синтетична таблиця позицій з тими ж колонками та типами, що приходять з `*_mt5_data`."""
+    rng = np.random.default_rng(seed)
+    net_profit = np.round(rng.normal(loc=0.5, scale=25.0, size=n_rows), 2)
+    time_open = 1_600_000_000 + np.cumsum(rng.integers(1, 600, size=n_rows))
+    time_close = time_open + rng.integers(1, 3_600, size=n_rows)
+    positions_df = pd.DataFrame({
+        "ticket": np.arange(1, n_rows + 1, dtype='int64'),
+        "symbol": rng.choice(np.array(["EURUSD", "GBPUSD", "XAUUSD", "USDJPY", "BTCUSD"]), size=n_rows),
+        "volume": np.round(rng.uniform(0.01, 2.0, size=n_rows), 2),
+        "time_open": time_open,
+        "time_close": time_close if epoch_time_close else pd.to_datetime(time_close, unit='s'),
+        "net_profit_db": net_profit,
+        "change_balance_acc": 10_000.0 + np.cumsum(net_profit),
+    })
+    # Перемішуємо, щоб очистка справді сортувала, і додаємо трохи пропусків, як у реальних таблицях
+    positions_df = positions_df.sample(frac=1.0, random_state=seed).reset_index(drop=True)
+    positions_df.loc[positions_df.sample(frac=0.001, random_state=seed + 1).index, "net_profit_db"] = np.nan
+    return positions_df
+
+
+def measure(stage_fn):
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = stage_fn()
+    elapsed = time.perf_counter() - started
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak_bytes
+
+
+def run_size(n_rows: int) -> list:
+    positions_df = make_positions_table(n_rows)
+    results = []
+
+    def record(stage, stage_fn):
+        result, elapsed, peak_bytes = measure(stage_fn)
+        results.append({"rows": n_rows, "stage": stage, "seconds": elapsed, "peak_mb": peak_bytes / 2**20})
+        return result
+
+    cleaned_df, _ = record("clean_trades", lambda: analytics.clean_trades(positions_df))
+    profits = cleaned_df[analytics.PROFIT_COLUMN].to_numpy()
+    balances = cleaned_df[analytics.BALANCE_COLUMN].to_numpy()
+    equity = record("equity_curve", lambda: analytics.equity_curve(profits))
+    record("running_max_drawdown", lambda: analytics.running_max_drawdown(equity))
+    record("rolling_win_rate", lambda: analytics.rolling_win_rate(profits, ROLLING_WINDOW))
+    record("profit_factor", lambda: analytics.profit_factor(profits))
+    returns = record("trade_returns", lambda: analytics.trade_returns(profits, balances))
+    record("sharpe_sortino", lambda: (analytics.sharpe_ratio(returns), analytics.sortino_ratio(returns)))
+    record("min_max_downsample", lambda: analytics.min_max_downsample_indices(equity, DOWNSAMPLE_BUCKETS))
+    close_times_ns = pd.DatetimeIndex(cleaned_df["time_close_dt"]).as_unit('ns').asi8
+    record("rollup_trades", lambda: {
+        resolution: analytics.rollup_trades(close_times_ns, profits, balances, equity, resolution)
+        for resolution in analytics.ROLLUP_RESOLUTIONS
+    })
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Бенчмарк етапів analytics.py на синтетичних таблицях позицій")
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(DEFAULT_SIZES), help="Кількість рядків")
+    parser.add_argument("--json", dest="json_path", help="Куди зберегти результати у JSON")
+    args = parser.parse_args(argv)
+
+    all_results = []
+    print(f"{'rows':>12}  {'stage':<22} {'seconds':>10} {'peak MB':>10}")
+    for n_rows in args.sizes:
+        for row in run_size(n_rows):
+            all_results.append(row)
+            print(f"{row['rows']:>12,}  {row['stage']:<22} {row['seconds']:>10.4f} {row['peak_mb']:>10.1f}")
+
+    if args.json_path:
+        Path(args.json_path).write_text(json.dumps(all_results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
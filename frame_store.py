@@ -0,0 +1,156 @@
+# ---- СПІЛЬНЕ СХОВИЩЕ ФРЕЙМІВ ----
+# Одне сховище на процес (створюється через st.cache_resource) замість копії фрейму в кожній сесії:
+# st.cache_data віддає кожному виклику свіжу розпікловану копію, а session_state тримав би ще одну.
+# Фрейми в сховищі компактні (див. compact_frame) і лише для читання - хто хоче змінювати, робить .copy().
+# Загальний бюджет пам'яті з LRU-витісненням; сесії зберігають тільки ключ і беруть фрейм зі сховища.
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+# Частка унікальних значень, нижче якої текстова колонка стає категоріальною
+CATEGORY_MAX_UNIQUE_RATIO = 0.5
+
+
+def _is_exact_float32(values: pd.Series) -> bool:
+    as_float32 = values.astype('float32')
+    # Порівняння з NaN: NaN лишається NaN, тож рівність перевіряємо тільки для заповнених значень
+    return bool(((as_float32.astype('float64') == values) | values.isna()).all())
+
+
+def compact_frame(df: pd.DataFrame, category_columns=(), keep_columns=()) -> pd.DataFrame:
+    """Копія df з компактними типами колонок.
+
+    float64 -> float32 лише якщо перетворення точне (грошові значення на кшталт 0.01 у float32 не
+    вміщаються, а втрата центів накопичилась би в кумулятивному профіті), цілі - до найменшого типу,
+    текст - категорія (category_columns або мало унікальних значень) чи Arrow-рядки замість object.
+    keep_columns не змінюються (напр. колонка watermark, яку порівнюють з параметрами запиту).
+    """
+    compact_columns = {}
+    for column_name in df.columns:
+        values = df[column_name]
+        if column_name in keep_columns:
+            compact_columns[column_name] = values
+        elif values.dtype == 'float64':
+            compact_columns[column_name] = values.astype('float32') if _is_exact_float32(values) else values
+        elif values.dtype.kind in 'iu':
+            compact_columns[column_name] = pd.to_numeric(values, downcast='integer')
+        elif (values.dtype == object or isinstance(values.dtype, pd.StringDtype)) \
+                and pd.api.types.infer_dtype(values, skipna=True) == 'string':
+            non_null_count = int(values.notna().sum())
+            if column_name in category_columns or (
+                    non_null_count and values.nunique(dropna=True) / non_null_count <= CATEGORY_MAX_UNIQUE_RATIO):
+                compact_columns[column_name] = values.astype('category')
+            elif values.dtype == object:
+                compact_columns[column_name] = values.astype(pd.ArrowDtype(pa.string()))
+            else:
+                compact_columns[column_name] = values
+        else:
+            # datetime, Decimal з numeric-колонок, bool, вже категоріальні - як є
+            compact_columns[column_name] = values
+    return pd.DataFrame(compact_columns, index=df.index)
+
+
+def append_compact(compact_df: pd.DataFrame, delta_df: pd.DataFrame, category_columns=(), keep_columns=()) -> pd.DataFrame:
+    """compact_df (вже стиснений compact_frame) + delta_df без повторного стиснення всієї історії.
+
+    Стискається лише дельта, а її типи підганяються під compact_df: нові значення додаються в категорії
+    (інакше concat категорії з рядками дав би object), цілі та float32 - якщо значення вміщаються без втрат.
+    """
+    if compact_df.empty or list(compact_df.columns) != list(delta_df.columns):
+        return compact_frame(pd.concat([compact_df, delta_df], ignore_index=True), category_columns, keep_columns)
+    if delta_df.empty:
+        return compact_df.reset_index(drop=True)
+
+    head_columns, tail_columns = {}, {}
+    for column_name in compact_df.columns:
+        head, tail = compact_df[column_name], delta_df[column_name]
+        if column_name not in keep_columns:
+            head, tail = _align_to_compact(head, tail)
+        head_columns[column_name], tail_columns[column_name] = head.reset_index(drop=True), tail.reset_index(drop=True)
+    return pd.concat([pd.DataFrame(head_columns), pd.DataFrame(tail_columns)], ignore_index=True)
+
+
+def _align_to_compact(head: pd.Series, tail: pd.Series) -> tuple:
+    if isinstance(head.dtype, pd.CategoricalDtype):
+        tail_values = tail.cat.categories if isinstance(tail.dtype, pd.CategoricalDtype) else pd.Index(tail.dropna().unique())
+        new_categories = tail_values.difference(head.cat.categories)
+        if len(new_categories):
+            # Лише дописує категорії, коди історії не перераховуються
+            head = head.cat.add_categories(new_categories)
+        return head, tail.astype(head.dtype)
+    if head.dtype == 'float32' and tail.dtype == 'float64' and _is_exact_float32(tail):
+        return head, tail.astype('float32')
+    if head.dtype.kind in 'iu' and tail.dtype.kind in 'iu' and len(tail):
+        head_limits = np.iinfo(head.dtype)
+        if head_limits.min <= tail.min() and tail.max() <= head_limits.max:
+            return head, tail.astype(head.dtype)
+        return head, tail
+    if isinstance(head.dtype, (pd.ArrowDtype, pd.StringDtype)) and tail.dtype == object \
+            and pd.api.types.infer_dtype(tail, skipna=True) == 'string':
+        return head, tail.astype(head.dtype)
+    return head, tail
+
+
+def frame_nbytes(df: pd.DataFrame) -> int:
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+
+def _entry_nbytes(entry: dict) -> int:
+    # Разом з похідними фреймами запису (напр. агрегати для графіків)
+    return frame_nbytes(entry["df"]) + sum(frame_nbytes(df) for df in (entry.get("rollups") or {}).values())
+
+
+class FrameStore:
+    """Потокобезпечне LRU-сховище записів {"df": DataFrame, ...} з бюджетом пам'яті в байтах.
+
+    Рахується пам'ять усіх фреймів разом; щойно покладений запис не витісняється, навіть якщо
+    він сам більший за бюджет - інакше сесія, що його завантажила, одразу його втратила б.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (entry, nbytes)
+        self._total_bytes = 0
+        self._evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def __contains__(self, key) -> bool:
+        # Без оновлення LRU-порядку: перевірка (напр. з префетчера) - не використання
+        with self._lock:
+            return key in self._entries
+
+    def __setitem__(self, key, entry: dict):
+        nbytes = _entry_nbytes(entry)
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._total_bytes -= previous[1]
+            self._entries[key] = (entry, nbytes)
+            self._total_bytes += nbytes
+            while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+                _, (_, evicted_nbytes) = self._entries.popitem(last=False)
+                self._total_bytes -= evicted_nbytes
+                self._evictions += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                return default
+            entry, nbytes = self._entries.pop(key)
+            self._total_bytes -= nbytes
+            return entry
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"frames": len(self._entries), "bytes": self._total_bytes,
+                    "max_bytes": self.max_bytes, "evictions": self._evictions}
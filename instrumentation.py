@@ -0,0 +1,173 @@
+# ---- ІНСТРУМЕНТАЦІЯ ----
+# Таймінги етапів кожного rerun та статистика кешу по таблицях. Реєстр живе на рівні процесу
+# (модуль імпортується один раз, на відміну від streamlit_app.py, що виконується заново на кожен rerun),
+# результати пишуться у JSON-лог (рядок на етап) та у файл у текстовому форматі Prometheus.
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+
+STAGE_BUCKETS_SECONDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+RECENT_SAMPLES_PER_STAGE = 500
+
+_cache_miss_flag = threading.local()
+_rotation_lock = threading.Lock()
+
+
+def mark_cache_miss():
+    """Викликається з тіла кешованої функції: якщо тіло виконалось, це промах кешу."""
+    _cache_miss_flag.value = True
+
+
+def reset_cache_miss():
+    _cache_miss_flag.value = False
+
+
+def was_cache_miss() -> bool:
+    return getattr(_cache_miss_flag, "value", False)
+
+
+class RerunTimings:
+    """Таймінги етапів одного rerun скрипта."""
+
+    def __init__(self, session_id: str, rerun_id: int):
+        self.session_id = session_id
+        self.rerun_id = rerun_id
+        self.started_at = time.time()
+        self.stages = []  # (stage, account_id, seconds)
+
+    @contextmanager
+    def stage(self, name: str, account_id: str | None = None):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages.append((name, account_id or "", time.perf_counter() - started))
+
+    def records(self) -> list:
+        return [
+            {"ts": self.started_at, "session": self.session_id, "rerun": self.rerun_id,
+             "stage": stage, "account_id": account_id, "seconds": round(seconds, 6)}
+            for stage, account_id, seconds in self.stages
+        ]
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}  # (stage, account_id) -> [лічильники бакетів..., +Inf, sum]
+        self._recent = {}  # stage -> deque останніх тривалостей (для p50/p95 у debug-панелі)
+        self._tables = {}  # table_name -> {"hits", "misses", "rows", "bytes"}
+
+    def observe_rerun(self, timings: RerunTimings):
+        with self._lock:
+            for stage, account_id, seconds in timings.stages:
+                histogram = self._histograms.setdefault((stage, account_id), [0] * (len(STAGE_BUCKETS_SECONDS) + 2) + [0.0])
+                bucket_idx = int(np.searchsorted(STAGE_BUCKETS_SECONDS, seconds, side="left"))
+                histogram[bucket_idx] += 1
+                histogram[-2] += 1  # count (+Inf)
+                histogram[-1] += seconds
+                self._recent.setdefault(stage, deque(maxlen=RECENT_SAMPLES_PER_STAGE)).append(seconds)
+
+    def record_table_load(self, table_name: str, hit: bool, rows: int, n_bytes: int):
+        with self._lock:
+            stats = self._tables.setdefault(table_name, {"hits": 0, "misses": 0, "rows": 0, "bytes": 0})
+            stats["hits" if hit else "misses"] += 1
+            stats["rows"] = rows
+            stats["bytes"] = n_bytes
+
+    def table_stats(self) -> dict:
+        with self._lock:
+            return {table_name: dict(stats) for table_name, stats in self._tables.items()}
+
+    def stage_percentiles(self) -> dict:
+        with self._lock:
+            samples = {stage: np.fromiter(values, dtype='float64') for stage, values in self._recent.items()}
+        return {
+            stage: {"p50": float(np.percentile(values, 50)), "p95": float(np.percentile(values, 95)), "samples": len(values)}
+            for stage, values in samples.items() if len(values)
+        }
+
+    def render_prometheus(self) -> str:
+        with self._lock:
+            histograms = {key: list(values) for key, values in self._histograms.items()}
+            tables = {table_name: dict(stats) for table_name, stats in self._tables.items()}
+
+        lines = [
+            "# HELP dashboard_stage_seconds Duration of dashboard rerun stages.",
+            "# TYPE dashboard_stage_seconds histogram",
+        ]
+        for (stage, account_id), histogram in sorted(histograms.items()):
+            labels = f'stage="{_escape_label(stage)}",account_id="{_escape_label(account_id)}"'
+            cumulative = np.cumsum(histogram[:len(STAGE_BUCKETS_SECONDS)])
+            for upper_bound, bucket_count in zip(STAGE_BUCKETS_SECONDS, cumulative):
+                lines.append(f'dashboard_stage_seconds_bucket{{{labels},le="{upper_bound}"}} {int(bucket_count)}')
+            lines.append(f'dashboard_stage_seconds_bucket{{{labels},le="+Inf"}} {int(histogram[-2])}')
+            lines.append(f"dashboard_stage_seconds_sum{{{labels}}} {histogram[-1]:.6f}")
+            lines.append(f"dashboard_stage_seconds_count{{{labels}}} {int(histogram[-2])}")
+
+        for metric, key, metric_type, help_text in (
+            ("dashboard_table_cache_hits_total", "hits", "counter", "Table loads served from cache."),
+            ("dashboard_table_cache_misses_total", "misses", "counter", "Table loads that queried the database."),
+            ("dashboard_table_rows", "rows", "gauge", "Rows in the last loaded frame."),
+            ("dashboard_table_bytes", "bytes", "gauge", "Shallow pandas memory of the last loaded frame."),
+        ):
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} {metric_type}")
+            for table_name, stats in sorted(tables.items()):
+                lines.append(f'{metric}{{table="{_escape_label(table_name)}"}} {stats[key]}')
+        return "\n".join(lines) + "\n"
+
+
+def _escape_label(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def append_json_log(path: Path, records: list, max_bytes: int | None = None, backup_count: int = 3):
+    """Дописує записи в JSONL; якщо файл перевищив max_bytes, він ротується в path.1 .. path.{backup_count}."""
+    if not records:
+        return
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if max_bytes is not None:
+        _rotate_if_larger(path, max_bytes, backup_count)
+    with open(path, "a", encoding="utf-8") as log_file:
+        log_file.write("".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records))
+
+
+def _rotate_if_larger(path: Path, max_bytes: int, backup_count: int):
+    try:
+        if path.stat().st_size < max_bytes:
+            return
+    except FileNotFoundError:
+        return
+    with _rotation_lock:
+        try:
+            if path.stat().st_size < max_bytes:
+                return  # інший потік вже ротував
+        except FileNotFoundError:
+            return
+        # os.replace атомарний: сесії, що саме дописують у старий файл, просто допишуть у path.1
+        for index in range(backup_count - 1, 0, -1):
+            backup_path = path.with_name(f"{path.name}.{index}")
+            if backup_path.exists():
+                os.replace(backup_path, path.with_name(f"{path.name}.{index + 1}"))
+        if backup_count > 0:
+            os.replace(path, path.with_name(f"{path.name}.1"))
+        else:
+            path.unlink(missing_ok=True)
+
+
+def write_prometheus_file(path: Path, registry: MetricsRegistry):
+    # Атомарна заміна, щоб node_exporter textfile collector не прочитав напівзаписаний файл
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    tmp_path.write_text(registry.render_prometheus(), encoding="utf-8")
+    os.replace(tmp_path, path)
+
+
+REGISTRY = MetricsRegistry()
@@ -1,10 +1,31 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from pathlib import Path
+
 import streamlit as st
+import numpy as np
 import pandas as pd
 import plotly.express as px
+import plotly.graph_objects as go
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+from sqlalchemy import text as sql_text
 from streamlit_autorefresh import st_autorefresh
 
+import analytics
+import frame_store
+import instrumentation
+
 try:
-    from st_aggrid import AgGrid, GridOptionsBuilder, GridUpdateMode, DataReturnMode
+    from st_aggrid import AgGrid, GridOptionsBuilder, GridUpdateMode, DataReturnMode, JsCode
 except ImportError:
     st.error("Бібліотека streamlit-aggrid не знайдена...")
     AgGrid = None
@@ -34,11 +55,34 @@ st.markdown("""
 refresh_interval_seconds = 60
 refresh_count = st_autorefresh(interval=refresh_interval_seconds * 1000, limit=None, key="account_refresh")
 
+# ---- ІНСТРУМЕНТАЦІЯ ----
+# Кожен rerun міряє свої етапи (rerun_timings.stage(...)); в кінці скрипта результати потрапляють у
+# спільний реєстр процесу, JSON-лог та файл Prometheus, а за бажанням - у debug-панель сайдбару
+METRICS_DIR = Path(os.environ.get("DASHBOARD_METRICS_DIR", ".cache/metrics"))
+METRICS_FILES_ENABLED = os.environ.get("DASHBOARD_METRICS", "1") != "0"
+# stages.jsonl ротується за розміром (stages.jsonl.1 .. .3), щоб лог не ріс без меж на довгоживучій репліці
+METRICS_LOG_MAX_BYTES = int(os.environ.get("DASHBOARD_METRICS_LOG_MAX_MB", "64")) * 1024 * 1024
+METRICS_LOG_BACKUPS = 3
+if "metrics_session_id" not in st.session_state:
+    st.session_state.metrics_session_id = uuid.uuid4().hex[:12]
+rerun_timings = instrumentation.RerunTimings(st.session_state.metrics_session_id, refresh_count)
+
+# ---- РЕНДЕРИНГ ГРАФІКІВ ----
+# На кожен піксель ширини графіка залишаємо не більше 4 точок (first/min/max/last у бакеті),
+# тож розмір Plotly JSON обмежений незалежно від довжини історії
+CHART_PIXEL_WIDTH_DEFAULT = 1200
+
 # ---- ЗАГОЛОВОК ТА САЙДБАР (Залишаємо ваш приклад) ----
 with st.sidebar:
     # st.image("your_logo.png", width=150) # Розкоментуйте та замініть на своє лого
     st.header("Фільтри та Навігація")
     st.info(f"Торговий Дашборд v1.1 (Оновлення #{refresh_count})")
+    fast_chart_rendering = st.checkbox(
+        "Швидкий рендеринг графіків (WebGL + downsampling)", value=True,
+        help="Довгі історії зменшуються до кількох точок на піксель ширини графіка зі збереженням усіх мінімумів та максимумів."
+    )
+    show_debug_panel = st.checkbox("Панель продуктивності (debug)", value=False)
+    chart_pixel_width = st.number_input("Ширина графіків (px)", min_value=300, max_value=4000, value=CHART_PIXEL_WIDTH_DEFAULT, step=100)
 
 st.title("💰 Торговий Дашборд з Neon DB") # Оновимо заголовок
 # st.markdown("### Ваш персональний фінансовий аналітик") # Можна повернути, якщо подобається
@@ -64,6 +108,16 @@ def get_db_connection():
 
 @st.cache_data(ttl=300)
 def load_data(table_name: str):
+    return _fetch_table(table_name)
+
+@st.cache_data(ttl=DATA_VERSION_MAX_AGE_SECONDS, max_entries=32, show_spinner=False)
+def load_data_versioned(table_name: str, data_version: str):
+    # Версія з probe_table_versions входить у ключ кешу: поки таблиця не змінилась,
+    # автооновлення не йде в БД зовсім (на відміну від load_data, яка перечитує таблицю кожні 300 с)
+    return _fetch_table(table_name)
+
+def _fetch_table(table_name: str):
+    instrumentation.mark_cache_miss()
     local_conn = get_db_connection()
     if not local_conn:
         return pd.DataFrame()
@@ -98,45 +152,672 @@ def load_data(table_name: str):
         # Залишимо логування, щоб бачити, яку таблицю намагаємось запитати
         # st.caption(f"[DEBUG] Запит до таблиці: {query_table_name}")
 
+        # Спершу дисковий кеш: холодний процес (деплой, рестарт, нова репліка) не тягне таблицю з Neon,
+        # якщо її відбиток не змінився
+        disk_cache_key = f"load_data:{table_name}"
+        fingerprint = table_fingerprint(local_conn, table_name)
+        df = disk_cache_get(disk_cache_key, fingerprint)
+        if df is not None:
+            return df
+
         full_query_text = f'SELECT * FROM {query_table_name};'
-        df = local_conn.query(full_query_text)
+        df = local_conn.query(full_query_text, ttl=0)
+        disk_cache_put(disk_cache_key, fingerprint, df)
         
         # Прибираємо попередження про порожню таблицю тут, щоб не спамити при автооновленні
         return df
     except Exception as e:
-        # Якщо помилка через те, що таблиця не знайдена (це типово для ProgrammingError в psycopg2/sqlalchemy)
-        # (psycopg2.errors.UndefinedTable): relation "public.some_table" does not exist
-        if "UndefinedTable" in str(e) or "does not exist" in str(e) or "relation" in str(e) and "does not exist" in str(e):
-            st.warning(f"Таблиця '{query_table_name if 'query_table_name' in locals() else table_name}' не знайдена в базі даних.")
-        else:
-            st.error(f"Помилка при завантаженні даних з '{query_table_name_for_log}' (спроба запиту до '{query_table_name if 'query_table_name' in locals() else table_name}'): {e}")
+        _report_load_error(e, query_table_name_for_log, query_table_name if 'query_table_name' in locals() else table_name)
+        return pd.DataFrame()
+
+def _report_load_error(e: Exception, table_name: str, query_table_name: str):
+    # Якщо помилка через те, що таблиця не знайдена (це типово для ProgrammingError в psycopg2/sqlalchemy)
+    # (psycopg2.errors.UndefinedTable): relation "public.some_table" does not exist
+    if "UndefinedTable" in str(e) or "does not exist" in str(e) or "relation" in str(e) and "does not exist" in str(e):
+        st.warning(f"Таблиця '{query_table_name}' не знайдена в базі даних.")
+    else:
+        st.error(f"Помилка при завантаженні даних з '{table_name}' (спроба запиту до '{query_table_name}'): {e}")
+
+def _qualify_table_name(table_name: str) -> str:
+    # Та сама логіка, що й у load_data: public."table_name", якщо схема не вказана явно
+    if table_name.lower().startswith("public."):
+        return table_name
+    return f'public."{table_name}"'
+
+def _bare_table_name(table_name: str) -> str:
+    # Назва таблиці без схеми та лапок (для information_schema)
+    if table_name.lower().startswith("public."):
+        table_name = table_name[len("public."):]
+    return table_name.strip('"')
+
+# ---- ДИСКОВИЙ КЕШ ТАБЛИЦЬ (Arrow IPC) ----
+# st.cache_data живе лише в пам'яті процесу. Другий рівень кешу - файли Arrow IPC на диску, що переживають
+# рестарти та спільні для реплік на одному томі. Ключ - назва таблиці + дешевий відбиток свіжості
+# (кількість рядків, max time_close, лічильники змін з pg_stat_user_tables, схема).
+# Читання через memory map; при перевищенні DISK_CACHE_MAX_BYTES видаляються найдавніше використані файли.
+DISK_CACHE_DIR = Path(os.environ.get("DASHBOARD_DISK_CACHE_DIR", ".cache/tables"))
+DISK_CACHE_MAX_BYTES = int(os.environ.get("DASHBOARD_DISK_CACHE_MAX_MB", "2048")) * 1024 * 1024
+DISK_CACHE_ENABLED = os.environ.get("DASHBOARD_DISK_CACHE", "1") != "0"
+
+def table_fingerprint(local_conn, table_name: str, column_types: dict | None = None) -> str:
+    if column_types is None:
+        column_types = _get_column_types(local_conn, table_name)
+    max_time_close_sql = 'max("time_close")' if "time_close" in column_types else "NULL"
+    fingerprint_df = local_conn.query(
+        f"SELECT count(*) AS row_count, {max_time_close_sql} AS max_time_close, "
+        f"(SELECT n_tup_ins + n_tup_upd + n_tup_del FROM pg_stat_user_tables "
+        f" WHERE schemaname = 'public' AND relname = :bare_table_name) AS change_counter "
+        f"FROM {_qualify_table_name(table_name)};",
+        params={"bare_table_name": _bare_table_name(table_name)}, ttl=0
+    )
+    row = fingerprint_df.iloc[0]
+    fingerprint_source = (sorted(column_types.items()), int(row["row_count"]), str(row["max_time_close"]), str(row["change_counter"]))
+    return hashlib.sha1(repr(fingerprint_source).encode()).hexdigest()[:16]
+
+def _disk_cache_prefix(cache_key: str) -> str:
+    return hashlib.sha1(cache_key.encode()).hexdigest()[:24]
+
+def disk_cache_get(cache_key: str, fingerprint: str) -> pd.DataFrame | None:
+    if not DISK_CACHE_ENABLED:
+        return None
+    path = DISK_CACHE_DIR / f"{_disk_cache_prefix(cache_key)}-{fingerprint}.arrow"
+    try:
+        with pa.memory_map(str(path), "r") as source:
+            df = pa.ipc.open_file(source).read_all().to_pandas()
+        os.utime(path)  # mtime = час останнього використання, по ньому йде LRU-витіснення
+        return df
+    except FileNotFoundError:
+        return None
+    except Exception:
+        # Пошкоджений / недописаний файл - просто промах кешу
+        path.unlink(missing_ok=True)
+        return None
+
+def disk_cache_put(cache_key: str, fingerprint: str, df: pd.DataFrame):
+    if not DISK_CACHE_ENABLED:
+        return
+    prefix = _disk_cache_prefix(cache_key)
+    path = DISK_CACHE_DIR / f"{prefix}-{fingerprint}.arrow"
+    tmp_path = path.with_suffix(f".tmp{os.getpid()}.{threading.get_ident()}")
+    try:
+        DISK_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        with pa.OSFile(str(tmp_path), "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+        os.replace(tmp_path, path)  # атомарно: читачі ніколи не бачать напівзаписаний файл
+    except Exception:
+        # Колонки, які Arrow не вміє серіалізувати, або немає місця на диску - працюємо без дискового кешу
+        tmp_path.unlink(missing_ok=True)
+        return
+    for stale_path in DISK_CACHE_DIR.glob(f"{prefix}-*.arrow"):
+        if stale_path != path:
+            stale_path.unlink(missing_ok=True)
+    _disk_cache_evict()
+
+def _disk_cache_evict():
+    cached_files = []
+    for path in DISK_CACHE_DIR.glob("*.arrow"):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        cached_files.append((stat.st_mtime, stat.st_size, path))
+    total_bytes = sum(size for _, size, _ in cached_files)
+    for _, size, path in sorted(cached_files, key=lambda item: item[0]):
+        if total_bytes <= DISK_CACHE_MAX_BYTES:
+            break
+        path.unlink(missing_ok=True)
+        total_bytes -= size
+
+# ---- ВИЯВЛЕННЯ ЗМІН ДАНИХ ----
+# Один легкий запит до pg_stat_user_tables повертає лічильники вставок/оновлень/видалень для потрібних таблиць.
+# Якщо лічильники не змінились з попереднього rerun, пропускаємо завантаження, перебудову графіків
+# та перемонтування гріда. Лічильники обнуляються після рестарту чи відновлення Postgres, pg_stat_reset()
+# або призупинення compute в Neon - і тиха таблиця знову показала б уже бачену трійку, тож у версію входить
+# епоха статистики (час старту postmaster та stats_reset бази). Кеші, ключовані версією, мають ще й TTL
+# (DATA_VERSION_MAX_AGE_SECONDS) на випадок скидання, яке епоха не ловить (напр. лічильників однієї таблиці).
+CHANGE_PROBE_TTL_SECONDS = 10
+DATA_VERSION_MAX_AGE_SECONDS = 1800
+TABLE_VERSIONS_SQL = (
+    "SELECT s.relname, s.n_tup_ins, s.n_tup_upd, s.n_tup_del, "
+    "pg_postmaster_start_time()::text AS started_at, COALESCE(d.stats_reset::text, '') AS stats_reset "
+    "FROM pg_stat_user_tables s JOIN pg_stat_database d ON d.datname = current_database() "
+    "WHERE s.schemaname = 'public' AND s.relname = ANY(:table_names) ORDER BY s.relname;"
+)
+
+def query_table_versions(local_conn, table_names) -> dict:
+    versions_df = local_conn.query(
+        TABLE_VERSIONS_SQL, params={"table_names": [_bare_table_name(name) for name in table_names]}, ttl=0
+    )
+    return {
+        relname: f"{started_at}|{stats_reset}|{n_tup_ins}-{n_tup_upd}-{n_tup_del}"
+        for relname, n_tup_ins, n_tup_upd, n_tup_del, started_at, stats_reset in versions_df.itertuples(index=False, name=None)
+    }
+
+@st.cache_data(ttl=CHANGE_PROBE_TTL_SECONDS, show_spinner=False)
+def probe_table_versions(table_names: tuple) -> dict:
+    try:
+        return query_table_versions(get_db_connection(), table_names)
+    except Exception:
+        # Без статистики просто працюємо як раніше (версія None = "могло змінитись")
+        return {}
+
+def table_data_version(table_versions: dict, table_name: str) -> str | None:
+    return table_versions.get(_bare_table_name(table_name))
+
+# ---- ІНКРЕМЕНТАЛЬНЕ ЗАВАНТАЖЕННЯ ТАБЛИЦЬ ПОЗИЦІЙ ----
+# Таблиці позицій тільки доповнюються новими угодами, тому замість SELECT * на кожному оновленні
+# пам'ятаємо high-watermark (max time_close або ticket) і догружаємо лише новіші рядки.
+# Повне перезавантаження - тільки якщо watermark пішов назад або змінилась схема таблиці.
+WATERMARK_COLUMN_CANDIDATES = ("time_close", "ticket")
+CUMULATIVE_PROFIT_SOURCE_COLUMN = "net_profit_db"
+
+# Типізований режим для графіків: вибір колонок, CAST, epoch -> timestamp, фільтр NULL та ORDER BY
+# виконуються на стороні Postgres, тож у pandas приходить вузький, вже відсортований фрейм
+TYPED_POSITION_COLUMNS = ("net_profit_db", "change_balance_acc", "time_close")
+NUMERIC_SQL_TYPES = ("smallint", "integer", "bigint", "numeric", "real", "double precision")
+# {col} - або сама колонка "time_close", або max("time_close") у probe-запиті
+TIME_CLOSE_SQL_EXPRESSIONS = {
+    "timestamp without time zone": ("{col}", 'CAST(:watermark AS timestamp)'),
+    "timestamp with time zone": ("({col} AT TIME ZONE 'UTC')", "(CAST(:watermark AS timestamp) AT TIME ZONE 'UTC')"),
+    "date": ("CAST({col} AS timestamp)", "CAST(:watermark AS date)"),
+}
+for _numeric_type in NUMERIC_SQL_TYPES:
+    TIME_CLOSE_SQL_EXPRESSIONS[_numeric_type] = (
+        "(to_timestamp({col}) AT TIME ZONE 'UTC')",
+        "EXTRACT(EPOCH FROM (CAST(:watermark AS timestamp) AT TIME ZONE 'UTC'))",
+    )
+
+# Фрейми позицій живуть в одному спільному сховищі (frame_store.FrameStore) з компактними типами
+# та LRU-витісненням у межах бюджету; сесії пам'ятають лише назву таблиці (current_positions_table_name)
+FRAME_STORE_MAX_BYTES = int(os.environ.get("DASHBOARD_FRAME_STORE_MAX_MB", "1024")) * 1024 * 1024
+POSITIONS_CATEGORY_COLUMNS = ("symbol",)
+
+@st.cache_resource
+def get_positions_cache():
+    # Спільний для всіх сесій кеш: {(table_name, typed): entry}, плюс замок на кожну таблицю,
+    # щоб дві сесії не догружали одну й ту саму дельту одночасно
+    return {"lock": threading.Lock(), "table_locks": {}, "entries": frame_store.FrameStore(FRAME_STORE_MAX_BYTES),
+            "typed_disabled": set()}
+
+def _watermark_to_param(value):
+    # numpy/pandas скаляри -> звичайні Python-значення для параметрів SQLAlchemy
+    if isinstance(value, pd.Timestamp):
+        return value.to_pydatetime()
+    if hasattr(value, "item"):
+        return value.item()
+    return value
+
+def _with_cumulative_profit(df: pd.DataFrame, offset: float = 0.0) -> pd.DataFrame:
+    if CUMULATIVE_PROFIT_SOURCE_COLUMN in df.columns:
+        profit = pd.to_numeric(df[CUMULATIVE_PROFIT_SOURCE_COLUMN], errors='coerce')
+        df['cumulative_profit'] = analytics.equity_curve(profit, initial=offset)
+    return df
+
+def _close_times_ns(df: pd.DataFrame) -> np.ndarray:
+    return pd.DatetimeIndex(df['time_close_dt']).as_unit('ns').asi8
+
+def _positions_rollups(df: pd.DataFrame, spec: dict, previous_rollups: dict | None = None, changed_from=None) -> dict | None:
+    # Погодинні / денні / тижневі агрегати для графіків (analytics.ROLLUP_RESOLUTIONS) - лише в типізованому
+    # режимі, де time_close_dt вже datetime без пропусків і відсортований. Після догрузки дельти
+    # перераховуються тільки бакети, починаючи з того, що містить старий watermark.
+    if not spec["typed"] or df.empty:
+        return None
+    trade_series = (
+        _close_times_ns(df), df['net_profit_db'].to_numpy(dtype='float64'),
+        df['change_balance_acc'].to_numpy(dtype='float64'), df['cumulative_profit'].to_numpy(dtype='float64'),
+    )
+    if previous_rollups is None or changed_from is None:
+        return {resolution: analytics.rollup_trades(*trade_series, resolution) for resolution in analytics.ROLLUP_RESOLUTIONS}
+    changed_from_ns = pd.Timestamp(changed_from).as_unit('ns').value
+    return {
+        resolution: analytics.extend_rollup(previous_rollups[resolution], *trade_series, resolution, changed_from_ns)
+        for resolution in analytics.ROLLUP_RESOLUTIONS
+    }
+
+def _compact_positions_frame(df: pd.DataFrame, spec: dict) -> pd.DataFrame:
+    # Колонку watermark не чіпаємо: її max() іде параметром у дельта-запит
+    return frame_store.compact_frame(df, category_columns=POSITIONS_CATEGORY_COLUMNS,
+                                     keep_columns=(spec["watermark_column"],))
+
+def _get_column_types(local_conn, table_name: str) -> dict:
+    types_df = local_conn.query(
+        "SELECT column_name, data_type FROM information_schema.columns "
+        "WHERE table_schema = 'public' AND table_name = :bare_table_name;",
+        params={"bare_table_name": _bare_table_name(table_name)}, ttl=0
+    )
+    return dict(zip(types_df["column_name"], types_df["data_type"]))
+
+def _untyped_positions_spec(watermark_column: str | None = None) -> dict:
+    quoted = f'"{watermark_column}"' if watermark_column else None
+    return {
+        "typed": False,
+        "select_sql": "*",
+        "filter_sql": None,
+        "order_sql": quoted,
+        "watermark_column": watermark_column,
+        "watermark_source_sql": quoted,
+        "watermark_probe_sql": f"max({quoted})" if quoted else None,
+        "watermark_predicate_sql": f"{quoted} >= :watermark" if quoted else None,
+    }
+
+def _typed_positions_spec(column_types: dict) -> dict | None:
+    if any(col not in column_types for col in TYPED_POSITION_COLUMNS):
+        return None
+    time_sql = TIME_CLOSE_SQL_EXPRESSIONS.get(column_types["time_close"])
+    if time_sql is None:
+        # Текстовий time_close - однозначно розпарсити на сервері не вийде, лишаємо pandas-шлях
+        return None
+    time_expr_template, watermark_param_sql = time_sql
+    time_close_expr = time_expr_template.format(col='"time_close"')
+    return {
+        "typed": True,
+        "select_sql": (
+            'CAST("net_profit_db" AS double precision) AS net_profit_db, '
+            'CAST("change_balance_acc" AS double precision) AS change_balance_acc, '
+            f'{time_close_expr} AS time_close_dt'
+        ),
+        "filter_sql": '"net_profit_db" IS NOT NULL AND "change_balance_acc" IS NOT NULL AND "time_close" IS NOT NULL',
+        "order_sql": '"time_close"',
+        "watermark_column": "time_close_dt",
+        "watermark_source_sql": '"time_close"',
+        "watermark_probe_sql": time_expr_template.format(col='max("time_close")'),
+        "watermark_predicate_sql": f'"time_close" >= {watermark_param_sql}',
+    }
+
+def _select_positions(local_conn, table_name: str, spec: dict, watermark=None) -> pd.DataFrame:
+    conditions = [spec["filter_sql"]] if spec["filter_sql"] else []
+    params = None
+    if watermark is not None:
+        conditions.append(spec["watermark_predicate_sql"])
+        params = {"watermark": _watermark_to_param(watermark)}
+    query_text = f'SELECT {spec["select_sql"]} FROM {_qualify_table_name(table_name)}'
+    if conditions:
+        query_text += " WHERE " + " AND ".join(conditions)
+    if spec["order_sql"]:
+        query_text += f' ORDER BY {spec["order_sql"]}'
+    return local_conn.query(query_text + ";", params=params, ttl=0)
+
+def _build_positions_entry(df: pd.DataFrame, spec: dict, column_count: int) -> dict:
+    if not spec["typed"]:
+        watermark_column = next((col for col in WATERMARK_COLUMN_CANDIDATES if col in df.columns), None)
+        spec = _untyped_positions_spec(watermark_column)
+    watermark_column = spec["watermark_column"]
+    watermark = None
+    if watermark_column is not None and not df.empty:
+        if not spec["typed"]:
+            # У типізованому режимі ORDER BY вже виконав Postgres
+            df = df.sort_values(by=watermark_column, kind='mergesort', na_position='first').reset_index(drop=True)
+        watermark = df[watermark_column].max()
+        if pd.isna(watermark):
+            watermark = None
+    df = _compact_positions_frame(_with_cumulative_profit(df), spec)
+    return {
+        "df": df,
+        "spec": spec,
+        "columns": tuple(col for col in df.columns if col != 'cumulative_profit'),
+        "column_count": column_count,
+        "watermark": watermark,
+        "watermark_rows": _count_watermark_rows(df, watermark_column, watermark),
+        "rollups": _positions_rollups(df, spec),
+    }
+
+def _full_reload_positions(local_conn, table_name: str, typed: bool) -> dict:
+    column_types = _get_column_types(local_conn, table_name)
+    spec = _typed_positions_spec(column_types) if typed else None
+    if spec is None:
+        spec = _untyped_positions_spec()
+    disk_cache_key = f"positions:{table_name}:{hashlib.sha1(spec['select_sql'].encode()).hexdigest()[:12]}"
+    fingerprint = table_fingerprint(local_conn, table_name, column_types)
+    positions_df = disk_cache_get(disk_cache_key, fingerprint)
+    if positions_df is None:
+        positions_df = _select_positions(local_conn, table_name, spec)
+        disk_cache_put(disk_cache_key, fingerprint, positions_df)
+    return _build_positions_entry(positions_df, spec, len(column_types))
+
+def _count_watermark_rows(df: pd.DataFrame, watermark_column: str | None, watermark) -> int:
+    if watermark is None:
+        return 0
+    return int((df[watermark_column] == watermark).sum())
+
+def _probe_positions_table(local_conn, table_name: str, spec: dict):
+    # (max watermark, кількість рядків з ним, кількість колонок). Рядки з тим самим max дописані пізніше
+    # не змінюють max - їх видно лише за кількістю. Підзапит з рівністю йде по індексу на колонці watermark
+    qualified_table_name = _qualify_table_name(table_name)
+    watermark_source = spec["watermark_source_sql"]
+    tie_conditions = [f"{watermark_source} = (SELECT max({watermark_source}) FROM {qualified_table_name})"]
+    if spec["filter_sql"]:
+        tie_conditions.append(spec["filter_sql"])
+    probe_df = local_conn.query(
+        f'SELECT {spec["watermark_probe_sql"]} AS max_watermark, '
+        f'(SELECT count(*) FROM {qualified_table_name} WHERE {" AND ".join(tie_conditions)}) AS max_watermark_rows, '
+        f'(SELECT count(*) FROM information_schema.columns '
+        f" WHERE table_schema = 'public' AND table_name = :bare_table_name) AS column_count "
+        f'FROM {qualified_table_name};',
+        params={"bare_table_name": _bare_table_name(table_name)}, ttl=0
+    )
+    probe_row = probe_df.iloc[0]
+    return probe_row["max_watermark"], int(probe_row["max_watermark_rows"]), int(probe_row["column_count"])
+
+def _refresh_positions_entry(local_conn, table_name: str, entry: dict | None, typed: bool) -> dict:
+    if entry is None or entry["watermark"] is None:
+        return _full_reload_positions(local_conn, table_name, typed)
+
+    spec, watermark = entry["spec"], entry["watermark"]
+    current_max, current_max_rows, column_count = _probe_positions_table(local_conn, table_name, spec)
+    if column_count != entry["column_count"] or pd.isna(current_max):
+        return _full_reload_positions(local_conn, table_name, typed)
+    try:
+        if current_max < watermark:
+            # Watermark пішов назад (видалення / перезаливка таблиці) - дельтою не обійтись
+            return _full_reload_positions(local_conn, table_name, typed)
+        if current_max == watermark and current_max_rows == entry.get("watermark_rows"):
+            return entry
+    except TypeError:
+        return _full_reload_positions(local_conn, table_name, typed)
+
+    # Беремо рядки з >= watermark: угоди з тим самим time_close могли дописатись після попереднього
+    # завантаження, тому граничні рядки з кешу відкидаємо і беремо їх заново з дельти
+    delta_df = _select_positions(local_conn, table_name, spec, watermark)
+    if tuple(delta_df.columns) != entry["columns"]:
+        return _full_reload_positions(local_conn, table_name, typed)
+
+    watermark_column = spec["watermark_column"]
+    # Стискається лише дельта з підгонкою під типи кешу - вартість злиття залежить від дельти, а не від історії
+    merged_df = analytics.merge_trades_delta(
+        entry["df"], delta_df, watermark_column, watermark,
+        append=lambda kept_df, fresh_df: frame_store.append_compact(
+            kept_df, fresh_df, category_columns=POSITIONS_CATEGORY_COLUMNS, keep_columns=(watermark_column,)
+        )
+    )
+
+    new_watermark = delta_df[watermark_column].max() if not delta_df.empty else watermark
+    if pd.isna(new_watermark):
+        new_watermark = watermark
+    return {**entry, "df": merged_df,
+            "watermark": new_watermark,
+            # Усі рядки з новим watermark прийшли в дельті (кешовані граничні рядки merge відкинув)
+            "watermark_rows": _count_watermark_rows(delta_df, watermark_column, new_watermark),
+            "rollups": _positions_rollups(merged_df, spec, entry.get("rollups"), watermark)}
+
+def load_positions_incremental(table_name: str, typed: bool = False) -> pd.DataFrame:
+    local_conn = get_db_connection()
+    if not local_conn:
         return pd.DataFrame()
+    return _load_positions(local_conn, get_positions_cache(), table_name, typed, report_errors=True)
+
+def positions_cache_key(cache: dict, table_name: str, typed: bool) -> tuple:
+    # Ключ, під яким _load_positions реально тримає таблицю: для таблиць з typed_disabled - нетипізований
+    return table_name, typed and table_name not in cache["typed_disabled"]
+
+def peek_positions_entry(table_name: str, typed: bool = False) -> dict | None:
+    """Запис зі спільного сховища (фрейм, агрегати, ...) без запитів до БД; None, якщо його немає або його витіснено."""
+    cache = get_positions_cache()
+    return cache["entries"].get(positions_cache_key(cache, table_name, typed))
+
+# SQLSTATE, після яких типізований режим для таблиці неможливий: клас 22 (data exception -
+# invalid_text_representation, datetime/numeric out of range, ...), cannot_coerce та undefined_function
+TYPED_CAST_ERROR_SQLSTATES = ("42846", "42883")
+
+def _is_typed_cast_error(e: Exception) -> bool:
+    # sqlalchemy.exc.DBAPIError тримає помилку драйвера в .orig, у psycopg2 код SQLSTATE - .pgcode
+    pgcode = getattr(getattr(e, "orig", e), "pgcode", None)
+    return pgcode is not None and (pgcode.startswith("22") or pgcode in TYPED_CAST_ERROR_SQLSTATES)
+
+def _load_positions(local_conn, cache: dict, table_name: str, typed: bool, report_errors: bool) -> pd.DataFrame:
+    # local_conn - st.connection або _EngineQueryConnection (фонові потоки без ScriptRunContext)
+    cache_key = positions_cache_key(cache, table_name, typed)
+    typed = cache_key[1]
+    with cache["lock"]:
+        table_lock = cache["table_locks"].setdefault(cache_key, threading.Lock())
+
+    with table_lock:
+        previous_entry = entry = cache["entries"].get(cache_key)
+        try:
+            entry = _refresh_positions_entry(local_conn, table_name, entry, typed)
+        except Exception as e:
+            cache["entries"].pop(cache_key, None)
+            if typed and _is_typed_cast_error(e):
+                # CAST не вдався через "брудні" значення - повертаємось до SELECT * та парсингу в pandas.
+                # Мережеві помилки, таймаути пулу тощо типізований режим не вимикають
+                cache["typed_disabled"].add(table_name)
+                return _load_positions(local_conn, cache, table_name, False, report_errors)
+            if report_errors:
+                _report_load_error(e, table_name, _qualify_table_name(table_name))
+            return pd.DataFrame()
+        if entry is not previous_entry:
+            # Запис у сховище перераховує пам'ять усього запису (memory_usage(deep=True)) - лише коли він змінився;
+            # LRU-порядок незміненого запису вже оновив get
+            cache["entries"][cache_key] = entry
+        instrumentation.REGISTRY.record_table_load(
+            table_name, hit=entry is previous_entry, rows=len(entry["df"]),
+            n_bytes=int(entry["df"].memory_usage(index=False).sum())
+        )
+        return entry["df"]
+
+# ---- ФОНОВЕ ПЕРЕДЗАВАНТАЖЕННЯ ТАБЛИЦЬ ПОЗИЦІЙ ----
+# Поки користувач дивиться на сторінку гріда акаунтів, таблиці позицій цих акаунтів (та нещодавно
+# переглянутих) догружаються у спільний кеш позицій, тож вкладка "Деталі Позицій" відкривається одразу.
+# Кількість потоків обмежена, щоб не вичерпати пул з'єднань Neon.
+PREFETCH_MAX_WORKERS = 2
+PREFETCH_RECENT_ACCOUNTS = 5
+PREFETCH_FAILED_RETRY_SECONDS = 300
+
+class _EngineQueryConnection:
+    """Мінімальний аналог SQLConnection.query поверх пулу SQLAlchemy.
+
+    st.connection(...).query працює через st.cache_data і потребує контексту скрипта,
+    тому у фонових потоках запити йдуть напряму через engine.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def query(self, sql: str, params: dict | None = None, ttl=None) -> pd.DataFrame:
+        with self.engine.connect() as connection:
+            return pd.read_sql(sql_text(sql), connection, params=params)
+
+class PositionsPrefetcher:
+    def __init__(self, query_conn: _EngineQueryConnection, positions_cache: dict, max_workers: int):
+        self._query_conn = query_conn
+        self._positions_cache = positions_cache
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="positions-prefetch")
+        self._lock = threading.Lock()
+        self._pending = {}  # session_key -> (набір таблиць, futures)
+        self._failed_tables = {}  # таблиця -> time.monotonic() невдачі: не смикаємо її на кожному оновленні
+
+    def schedule(self, session_key: str, table_names: list):
+        """Ставить таблиці в чергу; попередня черга цієї сесії скасовується, якщо набір змінився."""
+        requested = tuple(dict.fromkeys(table_names))
+        with self._lock:
+            previous_tables, previous_futures = self._pending.pop(session_key, ((), []))
+            # Сесії не повідомляють про завершення: черги, в яких усе виконано, більше не потрібні
+            for other_key in [key for key, (_, other_futures) in self._pending.items()
+                              if all(future.done() for future in other_futures)]:
+                del self._pending[other_key]
+            if previous_tables == requested and not all(future.done() for future in previous_futures):
+                self._pending[session_key] = (previous_tables, previous_futures)
+                return
+            for future in previous_futures:
+                future.cancel()  # вже запущені догрузки завершаться, а ті, що в черзі - ні
+            futures = [
+                self._executor.submit(self._prefetch, table_name)
+                for table_name in requested
+                if not self._is_cached(table_name) and not self._recently_failed(table_name)
+            ]
+            if futures:
+                self._pending[session_key] = (requested, futures)
+
+    def _is_cached(self, table_name: str) -> bool:
+        return positions_cache_key(self._positions_cache, table_name, True) in self._positions_cache["entries"]
+
+    def _recently_failed(self, table_name: str) -> bool:
+        # Невдача може бути тимчасовою (мережа, таймаут пулу), тож через PREFETCH_FAILED_RETRY_SECONDS пробуємо знову
+        failed_at = self._failed_tables.get(table_name)
+        return failed_at is not None and time.monotonic() - failed_at < PREFETCH_FAILED_RETRY_SECONDS
+
+    def _prefetch(self, table_name: str):
+        if self._is_cached(table_name):
+            return
+        _load_positions(self._query_conn, self._positions_cache, table_name, typed=True, report_errors=False)
+        if not self._is_cached(table_name):
+            self._failed_tables[table_name] = time.monotonic()
+        else:
+            self._failed_tables.pop(table_name, None)
+
+@st.cache_resource
+def get_engine_query_connection():
+    return _EngineQueryConnection(get_db_connection().engine)
+
+@st.cache_resource
+def get_positions_prefetcher():
+    return PositionsPrefetcher(get_engine_query_connection(), get_positions_cache(), PREFETCH_MAX_WORKERS)
+
+def prefetch_positions_tables(table_names: list):
+    if "prefetch_session_key" not in st.session_state:
+        st.session_state.prefetch_session_key = uuid.uuid4().hex
+    recent_tables = st.session_state.get("recent_positions_tables", [])
+    get_positions_prefetcher().schedule(st.session_state.prefetch_session_key, list(table_names) + recent_tables)
+
+def remember_viewed_positions_table(table_name: str):
+    recent_tables = [name for name in st.session_state.get("recent_positions_tables", []) if name != table_name]
+    st.session_state.recent_positions_tables = ([table_name] + recent_tables)[:PREFETCH_RECENT_ACCOUNTS]
+
 
 # ---- НАЗВИ ТАБЛИЦЬ ТА ІНІЦІАЛІЗАЦІЯ ----
 ACCOUNTS_TABLE_NAME = "stat_user_account_v2" # Залишається без змін (якщо це так)
+ACCOUNT_COLUMNS_TO_DISPLAY_CONFIG = { # Тепер використовуємо platform_original для відображення
+    "account_id": "ID Акаунту", "platform_original": "Платформа", "user_id": "ID Користувача",
+    "broker_name": "Брокер", "server": "Сервер", "deposit_currency": "Валюта депозиту",
+    "account_type": "Тип акаунту", "account_status": "Статус акаунту", "is_active": "Активний",
+    "balance": "Баланс", "initial_deposit": "Початковий депозит",
+    "total_deposits": "Всього депозитів", "total_withdrawals": "Всього виведено",
+    "total_profit": "Загальний профіт"
+    # "platform_suffix_for_table": "Суфікс для таблиці" # Для дебагу можна додати
+}
 # НОВИЙ ШАБЛОН для таблиць позицій:
 # Припускаємо, що платформа (mt5/mt4) буде відома з даних головної таблиці акаунтів
 # або ви можете мати окремі функції для MT5 і MT4, якщо логіка сильно відрізняється
 DYNAMIC_POSITION_TABLE_NAME_TEMPLATE = "{account_id}_{platform_suffix}_data" # platform_suffix буде 'mt5' або 'mt4'
 
+# Логіка для визначення platform_suffix (mt5, mt4), векторно для всієї колонки
+def map_platform_suffixes(platform_values: pd.Series) -> pd.Series:
+    platform_lower = platform_values.astype(str).str.strip().str.lower()
+    suffixes = pd.Series(None, index=platform_values.index, dtype=object)
+    # mt5 перевіряється останнім, щоб мати пріоритет (як у попередній построковій версії)
+    suffixes = suffixes.mask(platform_lower.str.contains("mt4|metatrader 4", regex=True), "mt4")
+    suffixes = suffixes.mask(platform_lower.str.contains("mt5|metatrader 5", regex=True), "mt5")
+    return suffixes # None/NaN - платформу визначити не вдалося
+
+# ---- КАТАЛОГ ТАБЛИЦЬ ПОЗИЦІЙ ----
+# Один запит до pg_class/pg_attribute замість пробних SELECT * по кожній таблиці: які `*_mt4_data` / `*_mt5_data`
+# існують, оцінка кількості рядків і чи є в них колонки для KPI. Результат кешується на CATALOG_TTL_SECONDS,
+# тож нова таблиця позицій стає видимою щонайпізніше через цей час.
+CATALOG_TTL_SECONDS = 120
+POSITIONS_TABLE_NAME_PATTERN = r"^(?P<account_id>.+)_(?P<platform_suffix>mt4|mt5)_data$"
+CATALOG_KPI_COLUMNS = ("net_profit_db", "time_close")
+
+@st.cache_data(ttl=CATALOG_TTL_SECONDS, show_spinner=False)
+def load_positions_catalog() -> pd.DataFrame | None:
+    """Каталог таблиць позицій, індексований назвою таблиці; None, якщо каталог недоступний."""
+    try:
+        catalog_df = get_db_connection().query(
+            "SELECT c.relname AS table_name, GREATEST(c.reltuples, 0)::bigint AS row_estimate, "
+            "       count(a.attname) AS column_count, "
+            "       count(a.attname) FILTER (WHERE a.attname = ANY(:kpi_columns)) = :kpi_column_count AS has_kpi_columns "
+            "FROM pg_class c "
+            "JOIN pg_namespace n ON n.oid = c.relnamespace "
+            "LEFT JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped "
+            "WHERE n.nspname = 'public' AND c.relkind IN ('r', 'p') AND c.relname ~ '_(mt4|mt5)_data$' "
+            "GROUP BY c.relname, c.reltuples;",
+            params={"kpi_columns": list(CATALOG_KPI_COLUMNS), "kpi_column_count": len(CATALOG_KPI_COLUMNS)}, ttl=0
+        )
+    except Exception:
+        return None
+    name_parts = catalog_df["table_name"].str.extract(POSITIONS_TABLE_NAME_PATTERN)
+    return catalog_df.assign(
+        account_id=name_parts["account_id"], platform_suffix=name_parts["platform_suffix"]
+    ).set_index("table_name")
+
+@st.cache_data(ttl=CHANGE_PROBE_TTL_SECONDS, show_spinner=False)
+def _table_exists_in_db(table_name: str) -> bool:
+    try:
+        exists_df = get_db_connection().query(
+            "SELECT to_regclass(:qualified_table_name) IS NOT NULL AS table_exists;",
+            params={"qualified_table_name": _qualify_table_name(table_name)}, ttl=0
+        )
+    except Exception:
+        return True  # як без каталогу: далі load_* сам повідомить, якщо таблиці немає
+    return bool(exists_df.iloc[0]["table_exists"])
+
+def positions_table_exists(table_name: str, confirm_miss: bool = True) -> bool:
+    catalog_df = load_positions_catalog()
+    # Без каталогу поводимось як раніше: пробуємо завантажити, а load_* повідомить, якщо таблиці немає
+    if catalog_df is None or _bare_table_name(table_name) in catalog_df.index:
+        return True
+    # Каталог може бути до CATALOG_TTL_SECONDS старим: промах перевіряємо дешевим to_regclass,
+    # а якщо таблиця вже є - скидаємо каталог, щоб вона з'явилась і в переліках.
+    # confirm_miss=False (передзавантаження сторінки гріда) - лише каталог, без запиту на кожен промах
+    if confirm_miss and _table_exists_in_db(table_name):
+        load_positions_catalog.clear()
+        return True
+    return False
+
 if 'selected_account_id' not in st.session_state:
     st.session_state.selected_account_id = None
 if 'selected_account_platform_suffix' not in st.session_state: # Змінено для відображення нової логіки
     st.session_state.selected_account_platform_suffix = None
-if 'selected_account_positions_df' not in st.session_state:
-    st.session_state.selected_account_positions_df = pd.DataFrame()
 if 'current_positions_table_name' not in st.session_state:
     st.session_state.current_positions_table_name = ""
 
-conn = get_db_connection()
+with rerun_timings.stage("db_connection"):
+    conn = get_db_connection()
 
-# ---- ФУНКЦІЯ ВІДОБРАЖЕННЯ ГРАФІКІВ ПОЗИЦІЙ (без суттєвих змін, але увага до колонок) ----
-def display_position_charts(positions_df: pd.DataFrame, table_name: str, account_id_display: str):
-    if positions_df.empty:
-        return
+# Один probe-запит на rerun: таблиця акаунтів + таблиця позицій вибраного акаунту
+probed_tables = [ACCOUNTS_TABLE_NAME]
+if st.session_state.selected_account_id and st.session_state.selected_account_platform_suffix:
+    probed_tables.append(DYNAMIC_POSITION_TABLE_NAME_TEMPLATE.format(
+        account_id=st.session_state.selected_account_id,
+        platform_suffix=st.session_state.selected_account_platform_suffix
+    ))
+with rerun_timings.stage("change_probe"):
+    table_versions = probe_table_versions(tuple(probed_tables))
+accounts_data_version = table_data_version(table_versions, ACCOUNTS_TABLE_NAME)
 
-    st.header(f"Аналіз позицій для акаунту {account_id_display} (з таблиці: {table_name})")
+@st.cache_resource(ttl=DATA_VERSION_MAX_AGE_SECONDS, max_entries=4)
+def get_account_positions_index(data_version: str, _account_ids: pd.Series) -> pd.Index:
+    # Один індекс (з уже побудованою хеш-таблицею) на версію таблиці акаунтів, спільний для всіх сесій:
+    # поки таблиця не змінилась, пошук позиції акаунту - O(1) без перебудови індексу на кожному rerun.
+    # Індекс відповідає фрейму лише поки той самий запис load_data_versioned живий: після його TTL таблицю
+    # перечитано, і порядок рядків (SELECT без ORDER BY) може відрізнятись - тому позиції перевіряються при пошуку
+    account_positions_index = pd.Index(_account_ids.to_numpy(copy=True))
+    account_positions_index.get_indexer_for(account_positions_index[:1])
+    return account_positions_index
 
+def load_accounts_table() -> pd.DataFrame:
+    instrumentation.reset_cache_miss()
+    with rerun_timings.stage("load_data"):
+        if accounts_data_version is not None:
+            accounts_df = load_data_versioned(ACCOUNTS_TABLE_NAME, accounts_data_version)
+        else:
+            accounts_df = load_data(ACCOUNTS_TABLE_NAME)
+    instrumentation.REGISTRY.record_table_load(
+        ACCOUNTS_TABLE_NAME, hit=not instrumentation.was_cache_miss(), rows=len(accounts_df),
+        n_bytes=int(accounts_df.memory_usage(index=False).sum())
+    )
+    return accounts_df
+
+# ---- ФУНКЦІЯ ВІДОБРАЖЕННЯ ГРАФІКІВ ПОЗИЦІЙ (без суттєвих змін, але увага до колонок) ----
+def _is_typed_positions_frame(positions_df: pd.DataFrame) -> bool:
+    # Фрейм з типізованого режиму load_positions_incremental(typed=True): колонки вже приведені та відсортовані
+    if not {'net_profit_db', 'change_balance_acc', 'time_close_dt'}.issubset(positions_df.columns):
+        return False
+    return (pd.api.types.is_datetime64_any_dtype(positions_df['time_close_dt'])
+            and pd.api.types.is_float_dtype(positions_df['net_profit_db'])
+            and pd.api.types.is_float_dtype(positions_df['change_balance_acc']))
+
+def _clean_positions_for_charts(positions_df: pd.DataFrame, table_name: str):
+    # Шлях для SELECT * фреймів: приведення типів та розбір time_close (див. analytics.clean_trades)
     # ВАЖЛИВО: Перевірте, чи назви колонок 'net_profit_db', 'change_balance_acc', 'time_close'
     # залишилися такими ж у нових таблицях  `_mt5_data` / `_mt4_data`
     required_cols_positions = ['net_profit_db', 'change_balance_acc', 'time_close'] # АБО ЯК ВОНИ ТЕПЕР НАЗИВАЮТЬСЯ
@@ -145,94 +826,876 @@ def display_position_charts(positions_df: pd.DataFrame, table_name: str, account
     if missing_required_cols:
         st.error(f"У таблиці '{table_name}' відсутні необхідні колонки для графіків: {', '.join(missing_required_cols)}. "
                  f"Наявні колонки: {positions_df.columns.tolist()}")
-        return
+        return None
 
-    # ... (решта логіки display_position_charts залишається такою ж, як раніше,
-    #      за умови, що назви фінансових колонок і колонки часу не змінилися)
-    positions_df_cleaned = positions_df.copy()
-    for col in ['net_profit_db', 'change_balance_acc']: # Перевірте ці назви!
-        positions_df_cleaned[col] = pd.to_numeric(positions_df_cleaned[col], errors='coerce')
+    try:
+        positions_df_cleaned, time_kind = analytics.clean_trades(positions_df)
+    except Exception as e_clean:
+        st.error(f"Не вдалося обробити дані позицій з '{table_name}': {e_clean}")
+        return None
 
-    x_axis_data = positions_df_cleaned.index
-    x_axis_label = 'Номер угоди'
+    if time_kind == analytics.TIME_KIND_DATETIME:
+        return positions_df_cleaned, positions_df_cleaned['time_close_dt'], 'Час закриття'
+    if time_kind == analytics.TIME_KIND_NUMERIC:
+        return positions_df_cleaned, positions_df_cleaned.index, 'Номер угоди (Відсортовано за числовим time_close)'
+    if positions_df['time_close'].notna().any():
+        st.warning(f"Не вдалося використати 'time_close' для '{table_name}'. Використовується сортування за індексом.")
+    return positions_df_cleaned, positions_df_cleaned.index, 'Номер угоди'
 
-    if 'time_close' in positions_df_cleaned.columns: # Перевірте цю назву!
-        try:
-            temp_time_close = pd.to_datetime(positions_df_cleaned['time_close'], errors='coerce')
-            if temp_time_close.isnull().all():
-                temp_time_close = pd.to_datetime(positions_df_cleaned['time_close'], unit='s', origin='unix', errors='coerce')
-            
-            if not temp_time_close.isnull().all():
-                positions_df_cleaned['time_close_dt'] = temp_time_close
-                positions_df_cleaned.dropna(subset=['net_profit_db', 'change_balance_acc', 'time_close_dt'], inplace=True)
-                if not positions_df_cleaned.empty:
-                    positions_df_cleaned = positions_df_cleaned.sort_values(by='time_close_dt')
-                    x_axis_data = positions_df_cleaned['time_close_dt']
-                    x_axis_label = 'Час закриття'
-                else:
-                    positions_df_cleaned = positions_df.copy() 
-                    for col_num in ['net_profit_db', 'change_balance_acc']:
-                        positions_df_cleaned[col_num] = pd.to_numeric(positions_df_cleaned[col_num], errors='coerce')
-                    st.warning(f"Обробка 'time_close' як дати призвела до порожнього датасету для '{table_name}'. Використовується сортування за індексом.")
-                    positions_df_cleaned.dropna(subset=['net_profit_db', 'change_balance_acc'], inplace=True)
-
-            elif positions_df_cleaned['time_close'].notna().any():
-                try:
-                    positions_df_cleaned['time_close_numeric'] = pd.to_numeric(positions_df_cleaned['time_close'], errors='coerce')
-                    positions_df_cleaned.dropna(subset=['net_profit_db', 'change_balance_acc', 'time_close_numeric'], inplace=True)
-                    if not positions_df_cleaned.empty:
-                        positions_df_cleaned = positions_df_cleaned.sort_values(by='time_close_numeric')
-                        x_axis_data = positions_df_cleaned.index 
-                        x_axis_label = 'Номер угоди (Відсортовано за числовим time_close)'
-                except Exception as e_numeric:
-                     st.error(f"Не вдалося обробити 'time_close' ні як дату/час, ні як число: {e_numeric}")
-                     return
-            else:
-                 positions_df_cleaned.dropna(subset=['net_profit_db', 'change_balance_acc'], inplace=True)
-        except Exception as e_datetime:
-            st.warning(f"Загальна помилка при обробці 'time_close' для '{table_name}': {e_datetime}. Використовується сортування за індексом.")
-            positions_df_cleaned.dropna(subset=['net_profit_db', 'change_balance_acc'], inplace=True)
+def _position_metrics(positions_df_cleaned: pd.DataFrame) -> dict:
+    profits = positions_df_cleaned['net_profit_db'].to_numpy(dtype='float64')
+    returns = analytics.trade_returns(profits, positions_df_cleaned['change_balance_acc'].to_numpy(dtype='float64'))
+    return {
+        "max_drawdown": analytics.max_drawdown(positions_df_cleaned['cumulative_profit'].to_numpy(dtype='float64')),
+        "win_rate": analytics.win_rate(profits),
+        "profit_factor": analytics.profit_factor(profits),
+        # Коефіцієнти на одну угоду, без анюалізації
+        "sharpe": analytics.sharpe_ratio(returns, periods_per_year=1),
+        "sortino": analytics.sortino_ratio(returns, periods_per_year=1),
+    }
+
+def _build_line_chart(plot_df: pd.DataFrame, x_axis_data, y_col: str, title: str, y_label: str, x_axis_label: str):
+    x_name = x_axis_data.name if hasattr(x_axis_data, 'name') and x_axis_data.name else 'index'
+    if fast_chart_rendering:
+        keep_idx = analytics.min_max_downsample_indices(plot_df[y_col].to_numpy(), int(chart_pixel_width))
+        if len(keep_idx) < len(plot_df):
+            plot_df = plot_df.iloc[keep_idx]
+            x_axis_data = x_axis_data.iloc[keep_idx] if isinstance(x_axis_data, pd.Series) else x_axis_data[keep_idx]
+    return px.line(
+        plot_df, x=x_axis_data, y=y_col, title=title,
+        labels={y_col: y_label, x_name: x_axis_label},
+        render_mode='webgl' if fast_chart_rendering else 'auto'
+    )
+
+def _build_position_figures(positions_df: pd.DataFrame, table_name: str):
+    if _is_typed_positions_frame(positions_df):
+        # Все вже зроблено в SQL: без copy/to_numeric/to_datetime
+        positions_df_cleaned = positions_df
+        x_axis_data = positions_df_cleaned['time_close_dt']
+        x_axis_label = 'Час закриття'
     else:
-        positions_df_cleaned.dropna(subset=['net_profit_db', 'change_balance_acc'], inplace=True)
+        cleaned = _clean_positions_for_charts(positions_df, table_name)
+        if cleaned is None:
+            return None
+        positions_df_cleaned, x_axis_data, x_axis_label = cleaned
 
     if positions_df_cleaned.empty:
         st.info(f"Недостатньо даних для графіків '{table_name}' після очистки.")
-        return
+        return None
 
-    st.subheader("Кумулятивний профіт")
-    positions_df_cleaned['cumulative_profit'] = positions_df_cleaned['net_profit_db'].cumsum()
-    fig_cumulative_profit = px.line(
-        positions_df_cleaned, x=x_axis_data, y='cumulative_profit', title="Динаміка кумулятивного профіту",
-        labels={'cumulative_profit': 'Кумулятивний профіт', (x_axis_data.name if hasattr(x_axis_data, 'name') and x_axis_data.name else 'index'): x_axis_label }
+    if 'cumulative_profit' not in positions_df_cleaned.columns:
+        # Інкрементальний завантажувач вже веде кумулятивний профіт; рахуємо тільки якщо його немає
+        positions_df_cleaned['cumulative_profit'] = analytics.equity_curve(positions_df_cleaned['net_profit_db'])
+    fig_cumulative_profit = _build_line_chart(
+        positions_df_cleaned, x_axis_data, 'cumulative_profit', "Динаміка кумулятивного профіту",
+        'Кумулятивний профіт', x_axis_label
     )
     fig_cumulative_profit.update_layout(xaxis_title=x_axis_label, yaxis_title="Кумулятивний профіт ($)")
-    st.plotly_chart(fig_cumulative_profit, use_container_width=True)
 
-    st.subheader("Динаміка балансу рахунку")
     # Переконайтеся, що 'change_balance_acc' все ще актуальна назва колонки
-    fig_balance_change = px.line(
-        positions_df_cleaned, x=x_axis_data, y='change_balance_acc', title="Динаміка балансу рахунку",
-        labels={'change_balance_acc': 'Баланс', (x_axis_data.name if hasattr(x_axis_data, 'name') and x_axis_data.name else 'index'): x_axis_label}
+    fig_balance_change = _build_line_chart(
+        positions_df_cleaned, x_axis_data, 'change_balance_acc', "Динаміка балансу рахунку",
+        'Баланс', x_axis_label
     )
     fig_balance_change.update_layout(xaxis_title=x_axis_label, yaxis_title="Баланс рахунку ($)")
-    st.plotly_chart(fig_balance_change, use_container_width=True)
+    return fig_cumulative_profit, fig_balance_change, _position_metrics(positions_df_cleaned)
+
+# Типізовані фрейми мають агрегати (див. _positions_rollups): графіки будуються по вибраному вікну часу,
+# на сирих угодах - лише коли їх у вікні не більше ширини графіка, інакше з найдрібнішого рівня агрегації,
+# що вміщається в цю ширину. Вартість рендерингу залежить від вікна, а не від довжини всієї історії.
+CHART_WINDOW_SLIDER_STEPS = 2000
+ROLLUP_RESOLUTION_LABELS = {None: "окремі угоди", "hour": "погодинні агрегати", "day": "денні агрегати", "week": "тижневі агрегати"}
+
+def _select_chart_window(positions_df: pd.DataFrame, table_name: str) -> tuple:
+    """(start_ns, end_ns) зі слайдера часового вікна; вікно, що закінчувалось на останній угоді, рухається за новими угодами."""
+    first_close, last_close = positions_df['time_close_dt'].iloc[0], positions_df['time_close_dt'].iloc[-1]
+    if first_close == last_close:
+        return first_close.value, last_close.value
+    first_close, last_close = first_close.to_pydatetime(), last_close.to_pydatetime()
 
+    window_key = f"chart_window_{table_name}"
+    window_max_key = f"{window_key}_max"
+    slider_kwargs = {}
+    if window_key in st.session_state:
+        window_start, window_end = st.session_state[window_key]
+        if window_end >= st.session_state.get(window_max_key, last_close):
+            window_end = last_close
+        window_start = min(max(window_start, first_close), last_close)
+        st.session_state[window_key] = (window_start, max(window_start, min(window_end, last_close)))
+    else:
+        slider_kwargs["value"] = (first_close, last_close)
+    st.session_state[window_max_key] = last_close
+
+    # Крок datetime-слайдера за замовчуванням - доба, тож вікно вужче за день (а з ним і сирі угоди
+    # для акаунтів з > chart_pixel_width угод на добу) було б недосяжним. Крок - від хвилини до 15 хвилин
+    window_step = min(max((last_close - first_close) / CHART_WINDOW_SLIDER_STEPS, timedelta(minutes=1)), timedelta(minutes=15))
+    window_start, window_end = st.slider(
+        "Часове вікно графіків", min_value=first_close, max_value=last_close,
+        step=timedelta(minutes=window_step // timedelta(minutes=1)),
+        format="YYYY-MM-DD HH:mm", key=window_key, **slider_kwargs
+    )
+    return pd.Timestamp(window_start).as_unit('ns').value, pd.Timestamp(window_end).as_unit('ns').value
+
+def _cached_position_metrics(positions_df: pd.DataFrame, table_name: str, data_version: str | None) -> dict:
+    # Метрики - по всій історії, тож вони не залежать від вікна і рахуються раз на версію таблиці
+    metrics_cache_key = (table_name, data_version)
+    cached_metrics = st.session_state.get("position_metrics_cache")
+    if data_version is not None and cached_metrics is not None and cached_metrics[0] == metrics_cache_key:
+        return cached_metrics[1]
+    position_metrics = _position_metrics(positions_df)
+    st.session_state.position_metrics_cache = (metrics_cache_key, position_metrics)
+    return position_metrics
+
+def _build_rollup_equity_chart(rollup_df: pd.DataFrame, title: str):
+    fig = _build_line_chart(rollup_df, rollup_df['bucket_start'], 'equity_close', title, 'Кумулятивний профіт', 'Час закриття')
+    # Смуга min/max капіталу всередині бакета: екстремуми між точками закриття не губляться
+    fig.add_traces([
+        go.Scatter(x=rollup_df['bucket_start'], y=rollup_df['equity_max'], mode='lines', line_width=0,
+                   showlegend=False, hoverinfo='skip'),
+        go.Scatter(x=rollup_df['bucket_start'], y=rollup_df['equity_min'], mode='lines', line_width=0,
+                   fill='tonexty', fillcolor='rgba(99, 110, 250, 0.2)', name='min / max за період', hoverinfo='skip'),
+    ])
+    return fig
+
+def _build_windowed_position_figures(positions_df: pd.DataFrame, rollups: dict, chart_window: tuple, resolution: str | None,
+                                     table_name: str, data_version: str | None):
+    window_start_ns, window_end_ns = chart_window
+    if resolution is None:
+        close_times_ns = _close_times_ns(positions_df)
+        window_df = positions_df.iloc[np.searchsorted(close_times_ns, window_start_ns, side='left'):
+                                      np.searchsorted(close_times_ns, window_end_ns, side='right')]
+        fig_cumulative_profit = _build_line_chart(
+            window_df, window_df['time_close_dt'], 'cumulative_profit', "Динаміка кумулятивного профіту",
+            'Кумулятивний профіт', 'Час закриття'
+        )
+        fig_balance_change = _build_line_chart(
+            window_df, window_df['time_close_dt'], 'change_balance_acc', "Динаміка балансу рахунку", 'Баланс', 'Час закриття'
+        )
+    else:
+        rollup_df = rollups[resolution]
+        bucket_starts_ns = analytics.rollup_bucket_starts_ns(rollup_df)
+        first_bucket_ns = int(analytics.bucket_floor([window_start_ns], resolution)[0])
+        window_rollup_df = rollup_df.iloc[np.searchsorted(bucket_starts_ns, first_bucket_ns, side='left'):
+                                          np.searchsorted(bucket_starts_ns, window_end_ns, side='right')]
+        label = ROLLUP_RESOLUTION_LABELS[resolution]
+        fig_cumulative_profit = _build_rollup_equity_chart(window_rollup_df, f"Динаміка кумулятивного профіту ({label})")
+        fig_balance_change = _build_line_chart(
+            window_rollup_df, window_rollup_df['bucket_start'], 'balance_close', f"Динаміка балансу рахунку ({label})",
+            'Баланс', 'Час закриття'
+        )
+    fig_cumulative_profit.update_layout(xaxis_title='Час закриття', yaxis_title="Кумулятивний профіт ($)")
+    fig_balance_change.update_layout(xaxis_title='Час закриття', yaxis_title="Баланс рахунку ($)")
+    return fig_cumulative_profit, fig_balance_change, _cached_position_metrics(positions_df, table_name, data_version)
+
+def display_position_charts(positions_df: pd.DataFrame, table_name: str, account_id_display: str, data_version: str | None = None,
+                            rollups: dict | None = None):
+    if positions_df.empty:
+        return
+
+    st.header(f"Аналіз позицій для акаунту {account_id_display} (з таблиці: {table_name})")
+
+    chart_window = resolution = None
+    if rollups is not None:
+        chart_window = _select_chart_window(positions_df, table_name)
+        resolution, n_points = analytics.choose_rollup_resolution(
+            _close_times_ns(positions_df), rollups, *chart_window, int(chart_pixel_width)
+        )
+        st.caption(f"Роздільність графіків: {ROLLUP_RESOLUTION_LABELS[resolution]} ({n_points:,} точок у вікні)")
+
+    # Поки версія таблиці, вікно та налаштування рендерингу ті самі, графіки не перебудовуються
+    figures_cache_key = (table_name, data_version, fast_chart_rendering, int(chart_pixel_width), chart_window)
+    cached_figures = st.session_state.get("position_figures_cache")
+    if data_version is not None and cached_figures is not None and cached_figures[0] == figures_cache_key:
+        fig_cumulative_profit, fig_balance_change, position_metrics = cached_figures[1]
+    else:
+        with rerun_timings.stage("positions_figures", account_id_display):
+            if chart_window is None:
+                figures = _build_position_figures(positions_df, table_name)
+            else:
+                figures = _build_windowed_position_figures(positions_df, rollups, chart_window, resolution, table_name, data_version)
+        if figures is None:
+            return
+        fig_cumulative_profit, fig_balance_change, position_metrics = figures
+        st.session_state.position_figures_cache = (figures_cache_key, figures)
+
+    col_dd, col_win_rate, col_pf, col_sharpe = st.columns(4)
+    col_dd.metric("Макс. просадка", f"{position_metrics['max_drawdown']:,.2f} $")
+    col_win_rate.metric("Win rate", f"{position_metrics['win_rate']:.1%}")
+    col_pf.metric("Profit factor", f"{position_metrics['profit_factor']:.2f}")
+    col_sharpe.metric("Sharpe / Sortino (на угоду)", f"{position_metrics['sharpe']:.2f} / {position_metrics['sortino']:.2f}")
+
+    with rerun_timings.stage("plotly_render", account_id_display):
+        st.subheader("Кумулятивний профіт")
+        st.plotly_chart(fig_cumulative_profit, use_container_width=True)
+
+        st.subheader("Динаміка балансу рахунку")
+        st.plotly_chart(fig_balance_change, use_container_width=True)
+
+
+# ---- KPI ПО ВСІХ АКАУНТАХ (ЗАГАЛЬНИЙ ОГЛЯД) ----
+# Замість load_data по кожній таблиці позицій рахуємо агрегати на сервері:
+# один згенерований UNION ALL з агрегатом на кожну таблицю, пачками по OVERVIEW_UNION_CHUNK_SIZE таблиць.
+# Результат кешується потаблично за версією таблиці, тож перераховуються лише змінені акаунти.
+OVERVIEW_UNION_CHUNK_SIZE = 100
+OVERVIEW_FAILED_RETRY_SECONDS = 300
+OVERVIEW_REQUIRED_COLUMNS = ("net_profit_db", "time_close")
+
+def _sql_literal(value: str) -> str:
+    return "'" + str(value).replace("'", "''") + "'"
+
+def _account_kpi_subquery(table_name: str, account_id: str) -> str:
+    # Просадка рахується від піку кумулятивного профіту (з нульовою стартовою точкою)
+    quoted_table = 'public."' + table_name.replace('"', '""') + '"'
+    return f"""SELECT {_sql_literal(account_id)} AS account_id, {_sql_literal(table_name)} AS table_name,
+       count(*) AS trade_count,
+       COALESCE(sum(p), 0) AS total_pnl,
+       count(*) FILTER (WHERE p > 0) AS win_count,
+       COALESCE(sum(p) FILTER (WHERE p > 0), 0) AS gross_profit,
+       COALESCE(-sum(p) FILTER (WHERE p < 0), 0) AS gross_loss,
+       COALESCE(max(peak - equity), 0) AS max_drawdown
+FROM (
+    SELECT p, equity, GREATEST(max(equity) OVER (ORDER BY rn), 0) AS peak
+    FROM (
+        SELECT p, sum(p) OVER w AS equity, row_number() OVER w AS rn
+        FROM (SELECT CAST("net_profit_db" AS double precision) AS p, "time_close"
+              FROM {quoted_table} WHERE "net_profit_db" IS NOT NULL) AS trades
+        WINDOW w AS (ORDER BY "time_close" ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW)
+    ) AS equity_curve
+) AS drawdowns"""
+
+def get_overview_tables(local_conn, table_to_account: dict):
+    """Існуючі таблиці позицій з потрібними колонками та версії даних кожної з них.
+
+    Версія - це лічильники вставок/оновлень/видалень з pg_stat_user_tables: запит іде тільки
+    в статистику і не сканує самі таблиці.
+    """
+    table_names = list(table_to_account)
+    catalog_df = load_positions_catalog()
+    if catalog_df is not None:
+        existing_names = pd.Index(table_names).intersection(catalog_df.index[catalog_df["has_kpi_columns"]])
+    else:
+        existing_names = local_conn.query(
+            "SELECT table_name FROM information_schema.columns "
+            "WHERE table_schema = 'public' AND table_name = ANY(:table_names) AND column_name = ANY(:required_columns) "
+            "GROUP BY table_name HAVING count(*) = :required_count;",
+            params={"table_names": table_names, "required_columns": list(OVERVIEW_REQUIRED_COLUMNS),
+                    "required_count": len(OVERVIEW_REQUIRED_COLUMNS)},
+            ttl=0
+        )["table_name"]
+    table_versions = query_table_versions(local_conn, table_names)
+    existing_tables = tuple(sorted((name, table_to_account[name]) for name in existing_names))
+    return existing_tables, table_versions
+
+@st.cache_resource
+def get_overview_kpi_cache() -> dict:
+    # Спільний для всіх сесій: table_name -> (версія таблиці, час розрахунку, рядок KPI або None, якщо таблиця не порахувалась)
+    return {"lock": threading.Lock(), "rows": {}}
+
+def _query_overview_chunk(local_conn, chunk: tuple) -> tuple[dict, list]:
+    """KPI для пачки таблиць одним UNION ALL; якщо пачка падає - потаблично, щоб знайти таблицю, що заважає."""
+    union_query = "\nUNION ALL\n".join(_account_kpi_subquery(table_name, account_id) for table_name, account_id in chunk)
+    try:
+        chunk_df = local_conn.query(union_query + ";", ttl=0)
+        return {row["table_name"]: row for row in chunk_df.to_dict("records")}, []
+    except Exception:
+        if len(chunk) == 1:
+            return {}, [chunk[0][0]]
+    rows, failed_tables = {}, []
+    for table_entry in chunk:
+        table_rows, table_failed = _query_overview_chunk(local_conn, (table_entry,))
+        rows.update(table_rows)
+        failed_tables.extend(table_failed)
+    return rows, failed_tables
+
+def compute_overview_kpis(existing_tables: tuple, table_versions: dict) -> tuple[pd.DataFrame, list]:
+    """KPI по акаунтах і список таблиць, які не вдалося порахувати.
+
+    Кешується потаблично за версією кожної таблиці: нова угода в одному акаунті перераховує лише його,
+    а не віконні функції по всьому парку. Таблиця, що падає (напр. нечисловий net_profit_db), кешується
+    як невдала до зміни своєї версії і не валить огляд для решти акаунтів.
+    """
+    kpi_cache = get_overview_kpi_cache()
+    now = time.monotonic()
+    with kpi_cache["lock"]:
+        cached_rows = dict(kpi_cache["rows"])
+
+    def is_fresh(table_name: str) -> bool:
+        cached = cached_rows.get(table_name)
+        version = table_versions.get(table_name)
+        if cached is None or version is None or cached[0] != version:
+            return False
+        # Невдача могла бути тимчасовою (обрив з'єднання) - її перевіряємо частіше, ніж готові KPI
+        max_age = DATA_VERSION_MAX_AGE_SECONDS if cached[2] is not None else OVERVIEW_FAILED_RETRY_SECONDS
+        return now - cached[1] < max_age
+
+    stale_tables = tuple(entry for entry in existing_tables if not is_fresh(entry[0]))
+    if stale_tables:
+        local_conn = get_db_connection()
+        computed_rows = {}
+        for chunk_start in range(0, len(stale_tables), OVERVIEW_UNION_CHUNK_SIZE):
+            chunk = stale_tables[chunk_start:chunk_start + OVERVIEW_UNION_CHUNK_SIZE]
+            chunk_rows, failed_tables = _query_overview_chunk(local_conn, chunk)
+            computed_rows.update((table_name, (table_versions.get(table_name), now, row)) for table_name, row in chunk_rows.items())
+            computed_rows.update((table_name, (table_versions.get(table_name), now, None)) for table_name in failed_tables)
+        cached_rows.update(computed_rows)
+        with kpi_cache["lock"]:
+            kpi_cache["rows"].update(computed_rows)
+
+    per_account_rows = [cached_rows[table_name][2] for table_name, _ in existing_tables if cached_rows[table_name][2] is not None]
+    failed_accounts = [account_id for table_name, account_id in existing_tables if cached_rows[table_name][2] is None]
+    if not per_account_rows:
+        return pd.DataFrame(), failed_accounts
+    per_account_df = pd.DataFrame(per_account_rows)
+    per_account_df["win_rate"] = per_account_df["win_count"] / per_account_df["trade_count"].where(per_account_df["trade_count"] > 0)
+    per_account_df["profit_factor"] = per_account_df["gross_profit"] / per_account_df["gross_loss"].where(per_account_df["gross_loss"] > 0)
+    return per_account_df.sort_values("total_pnl", ascending=False, ignore_index=True), failed_accounts
+
+def display_overview_kpis(accounts_df: pd.DataFrame):
+    local_conn = get_db_connection()
+    platform_suffixes = map_platform_suffixes(accounts_df["platform"])
+    table_to_account = {
+        DYNAMIC_POSITION_TABLE_NAME_TEMPLATE.format(account_id=account_id, platform_suffix=suffix): account_id
+        for account_id, suffix in zip(accounts_df["account_id"].astype(str).str.strip(), platform_suffixes)
+        if pd.notna(suffix)
+    }
+    if not table_to_account:
+        st.info("Немає акаунтів з визначеною платформою (mt5/mt4) для розрахунку показників.")
+        return
+
+    try:
+        existing_tables, table_versions = get_overview_tables(local_conn, table_to_account)
+    except Exception as e:
+        st.error(f"Не вдалося отримати список таблиць позицій: {e}")
+        return
+    if not existing_tables:
+        st.info("Не знайдено жодної таблиці позицій для акаунтів.")
+        return
+
+    with st.spinner(f"Розрахунок показників по {len(existing_tables)} акаунтах..."):
+        kpi_df, failed_accounts = compute_overview_kpis(existing_tables, table_versions)
+    if failed_accounts:
+        st.warning(f"Не вдалося порахувати показники для {len(failed_accounts)} акаунтів (пропущено): "
+                   f"{', '.join(failed_accounts[:20])}{' ...' if len(failed_accounts) > 20 else ''}")
+    if kpi_df.empty:
+        st.info("Немає даних для розрахунку показників.")
+        return
+
+    total_trades = int(kpi_df["trade_count"].sum())
+    total_gross_loss = kpi_df["gross_loss"].sum()
+    col_pnl, col_win_rate, col_pf, col_dd, col_trades = st.columns(5)
+    col_pnl.metric("Загальний P&L", f"{kpi_df['total_pnl'].sum():,.2f} $")
+    col_win_rate.metric("Win rate", f"{kpi_df['win_count'].sum() / total_trades:.1%}" if total_trades else "—")
+    col_pf.metric("Profit factor", f"{kpi_df['gross_profit'].sum() / total_gross_loss:.2f}" if total_gross_loss > 0 else "—")
+    col_dd.metric("Макс. просадка акаунту", f"{kpi_df['max_drawdown'].max():,.2f} $")
+    col_trades.metric("Угод / акаунтів", f"{total_trades:,} / {len(kpi_df)}")
+
+    st.subheader("Показники по акаунтах")
+    st.dataframe(
+        kpi_df[["account_id", "total_pnl", "trade_count", "win_rate", "profit_factor", "max_drawdown"]].rename(columns={
+            "account_id": "ID Акаунту", "total_pnl": "P&L", "trade_count": "Угод", "win_rate": "Win rate",
+            "profit_factor": "Profit factor", "max_drawdown": "Макс. просадка"
+        }),
+        use_container_width=True, hide_index=True
+    )
+
+
+# ---- СЕРВЕРНА ПАГІНАЦІЯ АКАУНТІВ ----
+# Для великих таблиць акаунтів у браузер іде лише поточна сторінка: сортування та фільтр стають
+# ORDER BY / WHERE, сторінки гортаються keyset-курсором (значення колонки сортування, account_id),
+# а сторінки та загальна кількість кешуються за версією даних.
+ACCOUNTS_PAGE_SIZE = 10
+ACCOUNTS_SERVER_PAGINATION_THRESHOLD = 5000
+# Та сама умова, що й у map_platform_suffixes: акаунти без визначеної платформи не показуються
+ACCOUNTS_PLATFORM_SQL_FILTER = (
+    "(lower(CAST(\"platform\" AS text)) LIKE '%mt5%' OR lower(CAST(\"platform\" AS text)) LIKE '%metatrader 5%' "
+    "OR lower(CAST(\"platform\" AS text)) LIKE '%mt4%' OR lower(CAST(\"platform\" AS text)) LIKE '%metatrader 4%')"
+)
+
+@st.cache_data(ttl=600, show_spinner=False)
+def estimate_table_rows(table_name: str) -> int:
+    # Оцінка з pg_class (оновлюється ANALYZE/autovacuum) - без сканування таблиці
+    try:
+        estimate_df = get_db_connection().query(
+            "SELECT COALESCE(reltuples, 0)::bigint AS estimate FROM pg_class WHERE oid = to_regclass(:qualified_name);",
+            params={"qualified_name": _qualify_table_name(table_name)}, ttl=0
+        )
+    except Exception:
+        return 0
+    return int(estimate_df.iloc[0]["estimate"]) if not estimate_df.empty else 0
+
+@st.cache_data(ttl=600, show_spinner=False)
+def get_table_columns(table_name: str) -> list:
+    return list(_get_column_types(get_db_connection(), table_name))
+
+def _accounts_filter_sql(filter_column: str | None, filter_value: str) -> tuple[list, dict]:
+    conditions, params = [ACCOUNTS_PLATFORM_SQL_FILTER], {}
+    if filter_column and filter_value:
+        escaped_value = filter_value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        conditions.append(f'CAST("{filter_column}" AS text) ILIKE :filter_pattern')
+        params["filter_pattern"] = f"%{escaped_value}%"
+    return conditions, params
+
+def _accounts_keyset_sql(sort_column: str, descending: bool, cursor: tuple | None) -> tuple[str, str | None, dict]:
+    direction, comparison = ("DESC", "<") if descending else ("ASC", ">")
+    if sort_column == "account_id":
+        order_sql = f'"account_id" {direction}'
+        if cursor is None:
+            return order_sql, None, {}
+        return order_sql, f'"account_id" {comparison} :cursor_account_id', {"cursor_account_id": cursor[1]}
+
+    # NULL-и колонки сортування йдуть в кінці, account_id - стабільний тай-брейкер
+    order_sql = f'"{sort_column}" {direction} NULLS LAST, "account_id" ASC'
+    if cursor is None:
+        return order_sql, None, {}
+    cursor_value, cursor_account_id = cursor
+    params = {"cursor_account_id": cursor_account_id}
+    if cursor_value is None:
+        return order_sql, '("{0}" IS NULL AND "account_id" > :cursor_account_id)'.format(sort_column), params
+    params["cursor_value"] = cursor_value
+    keyset_sql = (
+        f'("{sort_column}" {comparison} :cursor_value '
+        f'OR ("{sort_column}" = :cursor_value AND "account_id" > :cursor_account_id) '
+        f'OR "{sort_column}" IS NULL)'
+    )
+    return order_sql, keyset_sql, params
+
+@st.cache_data(ttl=DATA_VERSION_MAX_AGE_SECONDS, max_entries=512, show_spinner=False)
+def load_accounts_page(sort_column: str, descending: bool, filter_column: str | None, filter_value: str,
+                       cursor: tuple | None, page_size: int, data_version: str) -> pd.DataFrame:
+    """Одна сторінка акаунтів (+1 рядок, щоб знати, чи є наступна сторінка)."""
+    instrumentation.mark_cache_miss()
+    conditions, params = _accounts_filter_sql(filter_column, filter_value)
+    order_sql, keyset_sql, keyset_params = _accounts_keyset_sql(sort_column, descending, cursor)
+    if keyset_sql:
+        conditions.append(keyset_sql)
+    params.update(keyset_params)
+    params["page_limit"] = page_size + 1
+    try:
+        return get_db_connection().query(
+            f'SELECT * FROM {_qualify_table_name(ACCOUNTS_TABLE_NAME)} WHERE {" AND ".join(conditions)} '
+            f'ORDER BY {order_sql} LIMIT :page_limit;',
+            params=params, ttl=0
+        )
+    except Exception as e:
+        _report_load_error(e, ACCOUNTS_TABLE_NAME, _qualify_table_name(ACCOUNTS_TABLE_NAME))
+        return pd.DataFrame()
+
+@st.cache_data(ttl=DATA_VERSION_MAX_AGE_SECONDS, max_entries=128, show_spinner=False)
+def count_accounts(filter_column: str | None, filter_value: str, data_version: str) -> int:
+    conditions, params = _accounts_filter_sql(filter_column, filter_value)
+    try:
+        count_df = get_db_connection().query(
+            f'SELECT count(*) AS total FROM {_qualify_table_name(ACCOUNTS_TABLE_NAME)} WHERE {" AND ".join(conditions)};',
+            params=params, ttl=0
+        )
+    except Exception:
+        return 0
+    return int(count_df.iloc[0]["total"])
+
+def _accounts_page_cursor(last_row: pd.Series, sort_column: str) -> tuple:
+    sort_value = last_row[sort_column]
+    return (None if pd.isna(sort_value) else _watermark_to_param(sort_value), _watermark_to_param(last_row["account_id"]))
+
+def _go_to_next_accounts_page(cursor: tuple):
+    st.session_state.accounts_page_cursors = st.session_state.accounts_page_cursors + [cursor]
+
+def _go_to_previous_accounts_page():
+    st.session_state.accounts_page_cursors = st.session_state.accounts_page_cursors[:-1]
+
+def display_accounts_server_page() -> pd.DataFrame:
+    """Контроли сортування/фільтра/гортання та поточна сторінка акаунтів з БД."""
+    table_columns = get_table_columns(ACCOUNTS_TABLE_NAME)
+    # platform_original - похідна колонка, в SQL це "platform"
+    source_columns = {("platform" if key == "platform_original" else key): label for key, label in ACCOUNT_COLUMNS_TO_DISPLAY_CONFIG.items()}
+    available_columns = [col for col in source_columns if col in table_columns] or ["account_id"]
+
+    col_sort, col_direction, col_filter_column, col_filter_value = st.columns([2, 1, 2, 3])
+    sort_column = col_sort.selectbox("Сортувати за", available_columns, format_func=lambda col: source_columns.get(col, col))
+    descending = col_direction.checkbox("За спаданням", value=False)
+    filter_column = col_filter_column.selectbox("Фільтр по колонці", available_columns, format_func=lambda col: source_columns.get(col, col))
+    filter_value = col_filter_value.text_input("Містить", value="").strip()
+
+    # Зміна сортування чи фільтра - починаємо з першої сторінки
+    page_query = (sort_column, descending, filter_column, filter_value)
+    if st.session_state.get("accounts_page_query") != page_query:
+        st.session_state.accounts_page_query = page_query
+        st.session_state.accounts_page_cursors = [None]
+
+    data_version = accounts_data_version or f"refresh-{refresh_count}"
+    cursors = st.session_state.accounts_page_cursors
+    instrumentation.reset_cache_miss()
+    with rerun_timings.stage("load_accounts_page"):
+        page_df = load_accounts_page(sort_column, descending, filter_column, filter_value, cursors[-1], ACCOUNTS_PAGE_SIZE, data_version)
+        total_accounts = count_accounts(filter_column, filter_value, data_version)
+    instrumentation.REGISTRY.record_table_load(
+        f"{ACCOUNTS_TABLE_NAME}[page]", hit=not instrumentation.was_cache_miss(), rows=len(page_df),
+        n_bytes=int(page_df.memory_usage(index=False).sum())
+    )
+
+    has_next_page = len(page_df) > ACCOUNTS_PAGE_SIZE
+    page_df = page_df.iloc[:ACCOUNTS_PAGE_SIZE]
+    total_pages = max(1, -(-total_accounts // ACCOUNTS_PAGE_SIZE))
+
+    col_prev, col_page, col_next = st.columns([1, 3, 1])
+    col_prev.button("◀ Попередня", disabled=len(cursors) <= 1, on_click=_go_to_previous_accounts_page, key="accounts_prev_page")
+    col_page.caption(f"Сторінка {len(cursors)} з {total_pages} (акаунтів: {total_accounts})")
+    col_next.button(
+        "Наступна ▶", disabled=not has_next_page, key="accounts_next_page",
+        on_click=_go_to_next_accounts_page,
+        args=(_accounts_page_cursor(page_df.iloc[-1], sort_column),) if has_next_page else None
+    )
+    return page_df
+
+@st.cache_data(ttl=DATA_VERSION_MAX_AGE_SECONDS, max_entries=8, show_spinner=False)
+def load_account_platforms(data_version: str) -> pd.DataFrame:
+    # Для загального огляду потрібні лише account_id та platform - не тягнемо всю таблицю акаунтів
+    try:
+        return get_db_connection().query(
+            f'SELECT "account_id", "platform" FROM {_qualify_table_name(ACCOUNTS_TABLE_NAME)};', ttl=0
+        )
+    except Exception as e:
+        _report_load_error(e, ACCOUNTS_TABLE_NAME, _qualify_table_name(ACCOUNTS_TABLE_NAME))
+        return pd.DataFrame()
+
+
+# ---- ПОРІВНЯННЯ АКАУНТІВ ----
+# Таблиці позицій обраних акаунтів вантажаться паралельно (обмежений пул потоків поверх пулу з'єднань
+# SQLAlchemy) у той самий спільний кеш позицій, тож загальна затримка близька до найповільнішої таблиці.
+# Криві капіталу зводяться на спільну часову сітку векторно (analytics.resample_last_value).
+COMPARISON_MAX_WORKERS = 4
+COMPARISON_MAX_ACCOUNTS = 30
+
+@st.cache_resource
+def get_comparison_executor():
+    # Разом з PREFETCH_MAX_WORKERS не перевищує стандартний pool_size + max_overflow SQLAlchemy
+    return ThreadPoolExecutor(max_workers=COMPARISON_MAX_WORKERS, thread_name_prefix="positions-compare")
+
+def _load_positions_timed(query_conn, positions_cache: dict, table_name: str):
+    started = time.perf_counter()
+    positions_df = _load_positions(query_conn, positions_cache, table_name, typed=True, report_errors=False)
+    return positions_df, time.perf_counter() - started
+
+def load_positions_concurrently(table_names: list) -> dict:
+    """{table_name: (positions_df, секунд)} для всіх таблиць, завантажених паралельно."""
+    query_conn, positions_cache = get_engine_query_connection(), get_positions_cache()
+    futures = {
+        table_name: get_comparison_executor().submit(_load_positions_timed, query_conn, positions_cache, table_name)
+        for table_name in table_names
+    }
+    return {table_name: future.result() for table_name, future in futures.items()}
+
+def _equity_series(positions_df: pd.DataFrame) -> tuple | None:
+    # (час закриття у нс, кумулятивний профіт), відсортовані за часом
+    if positions_df.empty:
+        return None
+    if not _is_typed_positions_frame(positions_df):
+        if not {'net_profit_db', 'change_balance_acc'}.issubset(positions_df.columns):
+            return None
+        positions_df, time_kind = analytics.clean_trades(positions_df)
+        if time_kind != analytics.TIME_KIND_DATETIME or positions_df.empty:
+            return None
+    close_times = _close_times_ns(positions_df)
+    if 'cumulative_profit' in positions_df.columns:
+        equity = positions_df['cumulative_profit'].to_numpy(dtype='float64')
+    else:
+        equity = analytics.equity_curve(positions_df['net_profit_db'])
+    return close_times, equity
+
+def display_accounts_comparison():
+    catalog_df = load_positions_catalog()
+    if catalog_df is None or catalog_df.empty:
+        st.info("Не вдалося отримати перелік таблиць позицій для порівняння.")
+        return
+
+    table_options = sorted(catalog_df.index)
+    selected_tables = st.multiselect(
+        "Акаунти для порівняння", table_options, max_selections=COMPARISON_MAX_ACCOUNTS,
+        format_func=lambda table_name: f"{catalog_df.at[table_name, 'account_id']} ({catalog_df.at[table_name, 'platform_suffix']})",
+        key="comparison_tables"
+    )
+    if not selected_tables:
+        st.info("Оберіть кілька акаунтів, щоб накласти їхні криві кумулятивного профіту.")
+        return
+
+    # Як і для вкладки позицій: поки лічильники змін обраних таблиць ті самі, не ходимо в БД
+    # (ні probe-запитів інкрементального завантажувача, ні перебудови графіка) - зокрема на автооновленні
+    with rerun_timings.stage("comparison_probe"):
+        comparison_versions = probe_table_versions(tuple(selected_tables))
+    selected_versions = tuple(table_data_version(comparison_versions, table_name) for table_name in selected_tables)
+    comparison_cache_key = (tuple(selected_tables), selected_versions, int(chart_pixel_width))
+    cached_comparison = st.session_state.get("comparison_cache")
+    if None not in selected_versions and cached_comparison is not None and cached_comparison[0] == comparison_cache_key:
+        comparison = cached_comparison[1]
+    else:
+        comparison = _build_accounts_comparison(selected_tables, catalog_df)
+        st.session_state.comparison_cache = (comparison_cache_key, comparison)
+
+    fig_comparison, summary_rows, skipped_tables, load_caption = comparison
+    for table_name in skipped_tables:
+        st.warning(f"Для '{table_name}' немає даних з часом закриття - акаунт пропущено.")
+    if fig_comparison is None:
+        return
+    st.caption(load_caption)
+    st.plotly_chart(fig_comparison, use_container_width=True)
+    st.dataframe(pd.DataFrame(summary_rows), hide_index=True, use_container_width=True)
+
+def _build_accounts_comparison(selected_tables: list, catalog_df: pd.DataFrame) -> tuple:
+    """(фігура або None, рядки зведення, пропущені таблиці, підпис про час завантаження)."""
+    started = time.perf_counter()
+    with st.spinner(f"Паралельне завантаження {len(selected_tables)} таблиць позицій..."), \
+            rerun_timings.stage("comparison_load"):
+        loaded = load_positions_concurrently(selected_tables)
+    total_seconds = time.perf_counter() - started
+
+    equity_by_account, summary_rows, skipped_tables = {}, [], []
+    for table_name in selected_tables:
+        positions_df, load_seconds = loaded[table_name]
+        account_label = f"{catalog_df.at[table_name, 'account_id']} ({catalog_df.at[table_name, 'platform_suffix']})"
+        equity_series = _equity_series(positions_df)
+        if equity_series is None:
+            skipped_tables.append(table_name)
+            continue
+        equity_by_account[account_label] = equity_series
+        close_times, equity = equity_series
+        summary_rows.append({
+            "Акаунт": account_label, "Угод": len(equity), "P&L": float(equity[-1]) if len(equity) else 0.0,
+            "Макс. просадка": analytics.max_drawdown(equity), "Завантаження, с": round(load_seconds, 3),
+        })
+    if not equity_by_account:
+        return None, summary_rows, skipped_tables, ""
+
+    slowest_seconds = max(row["Завантаження, с"] for row in summary_rows)
+    load_caption = (f"Завантажено за {total_seconds:.2f} с (найповільніша таблиця: {slowest_seconds:.2f} с, "
+                    f"сума послідовних завантажень: {sum(row['Завантаження, с'] for row in summary_rows):.2f} с)")
+
+    with rerun_timings.stage("comparison_figure"):
+        time_min = min(close_times[0] for close_times, _ in equity_by_account.values() if len(close_times))
+        time_max = max(close_times[-1] for close_times, _ in equity_by_account.values() if len(close_times))
+        grid = np.linspace(time_min, time_max, num=int(chart_pixel_width)).astype('int64')
+        comparison_df = pd.DataFrame(
+            {label: analytics.resample_last_value(close_times, equity, grid) for label, (close_times, equity) in equity_by_account.items()},
+            index=pd.to_datetime(grid, unit='ns')
+        )
+        fig_comparison = px.line(
+            comparison_df, title="Кумулятивний профіт обраних акаунтів",
+            labels={"index": "Час закриття", "value": "Кумулятивний профіт ($)", "variable": "Акаунт"},
+            render_mode='webgl'
+        )
+        fig_comparison.update_layout(xaxis_title="Час закриття", yaxis_title="Кумулятивний профіт ($)")
+    return fig_comparison, summary_rows, skipped_tables, load_caption
+
+# ---- ЕКСПОРТ ІСТОРІЇ УГОД ----
+# COPY (SELECT ...) TO STDOUT стрімить таблицю з Postgres шматками прямо у файл (або в елемент zip-архіву),
+# DataFrame не будується. Parquet пишеться з того ж CSV потоковим читачем Arrow по батчах, тож пам'ять
+# процесу не залежить від розміру таблиці. Файли лежать у EXPORT_DIR і видаляються через EXPORT_MAX_AGE_SECONDS.
+EXPORT_DIR = Path(os.environ.get("DASHBOARD_EXPORT_DIR", ".cache/exports"))
+EXPORT_MAX_AGE_SECONDS = 3600
+EXPORT_DOWNLOAD_WINDOW_SECONDS = 600
+EXPORT_MAX_ACCOUNTS = 50
+EXPORT_COPY_BUFFER_BYTES = 1024 * 1024
+EXPORT_CSV_BLOCK_BYTES = 4 * 1024 * 1024
+EXPORT_FORMATS = {"CSV": ("csv", "text/csv"), "Parquet": ("parquet", "application/vnd.apache.parquet")}
+# Явні типи для потокового читача: виведення типів по першому блоку ламається на пізніших блоках
+PG_TO_ARROW_TYPES = {
+    # numeric лишається рядком (див. _csv_to_parquet): float64 втратив би точність грошових колонок,
+    # а для decimal без precision/scale у column_types нема меж
+    "smallint": pa.int64(), "integer": pa.int64(), "bigint": pa.int64(),
+    "real": pa.float64(), "double precision": pa.float64(),
+    "boolean": pa.bool_(), "date": pa.date32(),
+    "timestamp without time zone": pa.timestamp("us"),
+    "timestamp with time zone": pa.timestamp("us", tz="UTC"),
+}
+
+def _export_select_sql(table_name: str, column_types: dict, date_range: tuple | None) -> tuple[str, dict, bool]:
+    """(SELECT для COPY, параметри для mogrify, чи застосовано фільтр за датою)."""
+    select_sql = f"SELECT * FROM {_qualify_table_name(table_name)}"
+    time_sql = TIME_CLOSE_SQL_EXPRESSIONS.get(column_types.get("time_close"))
+    if date_range is None or time_sql is None:
+        return select_sql, {}, False
+    time_close_expr = time_sql[0].format(col='"time_close"')
+    date_from, date_to = date_range
+    select_sql += (f" WHERE {time_close_expr} >= CAST(%(date_from)s AS timestamp)"
+                   f" AND {time_close_expr} < CAST(%(date_to)s AS timestamp)")
+    return select_sql + ' ORDER BY "time_close"', {"date_from": date_from, "date_to": date_to + timedelta(days=1)}, True
+
+def _copy_table_to_csv(table_name: str, column_types: dict, date_range: tuple | None, out_file) -> bool:
+    select_sql, params, filtered = _export_select_sql(table_name, column_types, date_range)
+    # COPY не приймає bind-параметрів, тому значення підставляє mogrify драйвера (з екрануванням)
+    raw_conn = get_db_connection().engine.raw_connection()
+    try:
+        with raw_conn.cursor() as cursor:
+            copy_sql = cursor.mogrify(f"COPY ({select_sql}) TO STDOUT WITH (FORMAT csv, HEADER true)", params or None)
+            cursor.copy_expert(copy_sql.decode(), out_file, size=EXPORT_COPY_BUFFER_BYTES)
+    finally:
+        raw_conn.close()
+    return filtered
+
+def _csv_to_parquet(csv_path: Path, parquet_path: Path, column_types: dict):
+    convert_options = pacsv.ConvertOptions(
+        column_types={column: PG_TO_ARROW_TYPES.get(data_type, pa.string()) for column, data_type in column_types.items()},
+        true_values=["t"], false_values=["f"],
+        # У CSV від COPY NULL - порожнє поле без лапок, порожній рядок - "". Лише воно і є NULL:
+        # типові null_values Arrow зробили б NULL з текстових "NA", "NULL", "nan" тощо
+        null_values=[""], strings_can_be_null=True, quoted_strings_can_be_null=False,
+    )
+    reader = pacsv.open_csv(csv_path, read_options=pacsv.ReadOptions(block_size=EXPORT_CSV_BLOCK_BYTES),
+                            convert_options=convert_options)
+    with pq.ParquetWriter(parquet_path, reader.schema) as writer:
+        for batch in reader:
+            writer.write_batch(batch)
+
+def _export_table_to_path(table_name: str, date_range: tuple | None, extension: str, out_path: Path) -> bool:
+    column_types = _get_column_types(get_db_connection(), table_name)
+    if extension == "csv":
+        with open(out_path, "wb") as out_file:
+            return _copy_table_to_csv(table_name, column_types, date_range, out_file)
+    csv_path = out_path.with_suffix(".csv.tmp")
+    try:
+        with open(csv_path, "wb") as csv_file:
+            filtered = _copy_table_to_csv(table_name, column_types, date_range, csv_file)
+        _csv_to_parquet(csv_path, out_path, column_types)
+    finally:
+        csv_path.unlink(missing_ok=True)
+    return filtered
+
+def _cleanup_exports():
+    if not EXPORT_DIR.exists():
+        return
+    expire_before = time.time() - EXPORT_MAX_AGE_SECONDS
+    for path in EXPORT_DIR.iterdir():
+        try:
+            if path.stat().st_mtime < expire_before:
+                path.unlink()
+        except FileNotFoundError:
+            continue
+
+def export_positions_tables(table_names: list, export_format: str, date_range: tuple | None) -> tuple[Path, str, str, list]:
+    """Експортує таблиці позицій у файл (кілька таблиць - у zip-архів).
+
+    Повертає (шлях, назва файлу для завантаження, MIME-тип, таблиці без фільтра за датою).
+    """
+    _cleanup_exports()
+    EXPORT_DIR.mkdir(parents=True, exist_ok=True)
+    extension, mime = EXPORT_FORMATS[export_format]
+    export_id = uuid.uuid4().hex
+    unfiltered_tables = []
+
+    if len(table_names) == 1:
+        file_name = f"{table_names[0]}.{extension}"
+        out_path = EXPORT_DIR / f"{export_id}-{file_name}"
+    else:
+        file_name, mime = f"positions_export_{len(table_names)}_accounts.zip", "application/zip"
+        out_path = EXPORT_DIR / f"{export_id}.zip"
+    try:
+        if len(table_names) == 1:
+            if not _export_table_to_path(table_names[0], date_range, extension, out_path):
+                unfiltered_tables.append(table_names[0])
+        else:
+            with zipfile.ZipFile(out_path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+                for table_name in table_names:
+                    if extension == "csv":
+                        # CSV пишемо прямо в елемент архіву - без проміжного файлу
+                        column_types = _get_column_types(get_db_connection(), table_name)
+                        with archive.open(f"{table_name}.csv", "w", force_zip64=True) as member:
+                            filtered = _copy_table_to_csv(table_name, column_types, date_range, member)
+                    else:
+                        member_path = EXPORT_DIR / f"{export_id}-{table_name}.{extension}"
+                        try:
+                            filtered = _export_table_to_path(table_name, date_range, extension, member_path)
+                            archive.write(member_path, arcname=f"{table_name}.{extension}")
+                        finally:
+                            member_path.unlink(missing_ok=True)
+                    if not filtered:
+                        unfiltered_tables.append(table_name)
+    except Exception:
+        out_path.unlink(missing_ok=True)
+        raise
+    return out_path, file_name, mime, unfiltered_tables if date_range is not None else []
+
+def display_positions_export(default_table: str | None):
+    catalog_df = load_positions_catalog()
+    if catalog_df is None or catalog_df.empty:
+        st.info("Не вдалося отримати перелік таблиць позицій для експорту.")
+        return
+
+    table_options = sorted(catalog_df.index)
+    export_tables = st.multiselect(
+        "Акаунти", table_options, max_selections=EXPORT_MAX_ACCOUNTS,
+        default=[default_table] if default_table in catalog_df.index else [],
+        format_func=lambda table_name: f"{catalog_df.at[table_name, 'account_id']} ({catalog_df.at[table_name, 'platform_suffix']})",
+        key="export_tables"
+    )
+    export_format = st.radio("Формат", list(EXPORT_FORMATS), horizontal=True, key="export_format")
+    date_range = None
+    if st.checkbox("Лише угоди за період (за time_close)", key="export_filter_dates"):
+        selected_dates = st.date_input("Період", value=(), key="export_date_range")
+        if len(selected_dates) == 2:
+            date_range = tuple(selected_dates)
+        else:
+            st.caption("Оберіть початкову та кінцеву дату, інакше експортується вся історія.")
+
+    if st.button("Підготувати файл", disabled=not export_tables, key="export_prepare"):
+        _discard_prepared_export()
+        try:
+            with st.spinner(f"Експорт {len(export_tables)} таблиць позицій..."), rerun_timings.stage("positions_export"):
+                st.session_state.positions_export = export_positions_tables(export_tables, export_format, date_range)
+        except Exception as e:
+            st.session_state.positions_export = None
+            st.error(f"Не вдалося експортувати історію угод: {e}")
+
+    prepared_export = st.session_state.get("positions_export")
+    if prepared_export and (not prepared_export[0].exists()
+                            or time.time() - prepared_export[0].stat().st_mtime > EXPORT_DOWNLOAD_WINDOW_SECONDS):
+        # Кнопка мусить перерендерюватись на кожному rerun (інакше Streamlit звільняє файл), а кожен рендер
+        # читає файл у media store - тому незавантажений експорт живе лише EXPORT_DOWNLOAD_WINDOW_SECONDS
+        _discard_prepared_export()
+        st.info("Підготовлений файл не завантажили вчасно - підготуйте його ще раз.")
+        prepared_export = None
+    if prepared_export:
+        out_path, file_name, mime, unfiltered_tables = prepared_export
+        if unfiltered_tables:
+            st.warning("Без фільтра за датою (немає придатної колонки time_close): " + ", ".join(unfiltered_tables))
+        with open(out_path, "rb") as export_file:
+            # Після натискання файл вже віддано з media store: прибираємо стан і сам файл одразу
+            st.download_button(f"⬇️ Завантажити {file_name} ({out_path.stat().st_size / 1024 / 1024:.1f} МБ)",
+                               data=export_file, file_name=file_name, mime=mime, key="export_download",
+                               on_click=_discard_prepared_export)
+
+def _discard_prepared_export():
+    prepared_export = st.session_state.get("positions_export")
+    st.session_state.positions_export = None
+    if prepared_export:
+        prepared_export[0].unlink(missing_ok=True)
 
 # ---- ВКЛАДКИ ДЛЯ НАВІГАЦІЇ ----
-tab_overview, tab_accounts, tab_positions = st.tabs([
+tab_overview, tab_accounts, tab_positions, tab_comparison = st.tabs([
     "📊 Загальний Огляд",
     "👤 Акаунти",
-    "📈 Деталі Позицій"
+    "📈 Деталі Позицій",
+    "📉 Порівняння Акаунтів"
 ])
 
 with tab_overview:
-    st.header("Ключові Показники (Заглушка)")
-    # Тут можна додати агреговані дані по всіх акаунтах, якщо є
-    st.info("Ця вкладка для загального огляду. Наразі в розробці.")
+    st.header("Ключові Показники")
+    with rerun_timings.stage("load_account_platforms"):
+        overview_accounts_df = load_account_platforms(accounts_data_version or f"refresh-{refresh_count}")
+    if not overview_accounts_df.empty and {"account_id", "platform"}.issubset(overview_accounts_df.columns):
+        with rerun_timings.stage("overview_kpis"):
+            display_overview_kpis(overview_accounts_df)
+    else:
+        st.info(f"Таблиця акаунтів '{ACCOUNTS_TABLE_NAME}' порожня або не вдалося завантажити.")
 
 with tab_accounts:
     st.header(f"Інформація про акаунти (з таблиці: {ACCOUNTS_TABLE_NAME})")
-    accounts_df_global = load_data(ACCOUNTS_TABLE_NAME)
+    use_server_pagination = st.checkbox(
+        "Серверна пагінація", value=estimate_table_rows(ACCOUNTS_TABLE_NAME) > ACCOUNTS_SERVER_PAGINATION_THRESHOLD,
+        help="З бази завантажується лише поточна сторінка акаунтів; сортування та фільтр виконуються в SQL.",
+        key="accounts_server_pagination"
+    )
+    if use_server_pagination:
+        accounts_df_global = display_accounts_server_page()
+    else:
+        accounts_df_global = load_accounts_table()
 
     if not accounts_df_global.empty:
         # ВАЖЛИВО: Перевірте, чи є в `accounts_df_global` колонка,
@@ -246,16 +1709,7 @@ with tab_accounts:
             accounts_df_global["account_id"] = accounts_df_global["account_id"].astype(str).str.strip()
             accounts_df_global["platform_original"] = accounts_df_global["platform"].astype(str).str.strip() # Зберігаємо оригінал
 
-            # Логіка для визначення platform_suffix (mt5, mt4)
-            def get_platform_suffix(platform_value):
-                platform_val_lower = platform_value.lower()
-                if "mt5" in platform_val_lower or "metatrader 5" in platform_val_lower:
-                    return "mt5"
-                elif "mt4" in platform_val_lower or "metatrader 4" in platform_val_lower:
-                    return "mt4"
-                return None # Або якесь значення за замовчуванням / помилка
-
-            accounts_df_global["platform_suffix_for_table"] = accounts_df_global["platform_original"].apply(get_platform_suffix)
+            accounts_df_global["platform_suffix_for_table"] = map_platform_suffixes(accounts_df_global["platform_original"])
             
             # Відфільтровуємо акаунти, для яких не вдалося визначити суфікс, якщо потрібно
             accounts_to_display_df = accounts_df_global.dropna(subset=["platform_suffix_for_table"])
@@ -263,15 +1717,7 @@ with tab_accounts:
                  st.warning("Не вдалося визначити суфікс платформи (mt5/mt4) для жодного з акаунтів. Перевірте значення в колонці 'platform'.")
 
 
-            columns_to_display_config = { # Тепер використовуємо platform_original для відображення
-                "account_id": "ID Акаунту", "platform_original": "Платформа", "user_id": "ID Користувача",
-                "broker_name": "Брокер", "server": "Сервер", "deposit_currency": "Валюта депозиту",
-                "account_type": "Тип акаунту", "account_status": "Статус акаунту", "is_active": "Активний",
-                "balance": "Баланс", "initial_deposit": "Початковий депозит",
-                "total_deposits": "Всього депозитів", "total_withdrawals": "Всього виведено",
-                "total_profit": "Загальний профіт"
-                # "platform_suffix_for_table": "Суфікс для таблиці" # Для дебагу можна додати
-            }
+            columns_to_display_config = ACCOUNT_COLUMNS_TO_DISPLAY_CONFIG
             
             existing_display_cols_keys = [k for k, v in columns_to_display_config.items() if k in accounts_to_display_df.columns]
             display_df_aggrid = accounts_to_display_df[existing_display_cols_keys].copy()
@@ -279,6 +1725,7 @@ with tab_accounts:
 
             # ... (решта коду для AgGrid, як раніше, використовуючи display_df_aggrid)
             if AgGrid and not display_df_aggrid.empty:
+                grid_page_size = 10
                 gb = GridOptionsBuilder.from_dataframe(display_df_aggrid)
                 # ... (конфігурація колонок)
                 currency_columns_keys = ["balance", "initial_deposit", "total_deposits", "total_withdrawals", "total_profit"]
@@ -286,27 +1733,82 @@ with tab_accounts:
 
                 for col_name in currency_columns_renamed:
                     if col_name in display_df_aggrid.columns:
-                        gb.configure_column(col_name, type=["numericColumn", "numberColumnFilter", "customNumericFormat"], precision=2, aggFunc='sum')
+                        gb.configure_column(col_name, type=["numericColumn", "numberColumnFilter", "customNumericFormat"], precision=2, aggFunc='sum',
+                                            **({"filter": False} if use_server_pagination else {}))
                 
                 active_col_renamed = columns_to_display_config.get("is_active")
                 if active_col_renamed and active_col_renamed in display_df_aggrid.columns:
                     gb.configure_column(active_col_renamed, cellRenderer='agBooleanCellRenderer', editable=False, width=100)
 
                 gb.configure_selection(selection_mode='single', use_checkbox=False)
-                gb.configure_pagination(paginationAutoPageSize=False, paginationPageSize=10)
-                gb.configure_default_column(editable=False, filter=True, sortable=True, resizable=True)
+                if not use_server_pagination:
+                    gb.configure_pagination(paginationAutoPageSize=False, paginationPageSize=grid_page_size)
+                # У серверному режимі грід бачить лише поточну сторінку: сортування/фільтр - контролами над грідом
+                gb.configure_default_column(editable=False, filter=not use_server_pagination,
+                                            sortable=not use_server_pagination, resizable=True)
+                # Стабільний id рядка: при зміні даних ag-grid оновлює лише змінені рядки і зберігає вибір
+                gb.configure_grid_options(getRowId=JsCode(
+                    f"function(params) {{ return String(params.data[{json.dumps(columns_to_display_config['account_id'])}]); }}"
+                ))
                 gridOptions = gb.build()
 
                 st.subheader("Оберіть акаунт для перегляду деталей позицій:")
-                account_grid_response = AgGrid(
-                    display_df_aggrid, gridOptions=gridOptions, data_return_mode=DataReturnMode.AS_INPUT,
-                    update_mode=GridUpdateMode.MODEL_CHANGED, allow_unsafe_jscode=True, height=350,
-                    width='100%', fit_columns_on_grid_load=True, theme='streamlit',
-                    key=f"aggrid_accounts_{refresh_count}"
-                )
+                with rerun_timings.stage("aggrid_render"):
+                    account_grid_response = AgGrid(
+                        display_df_aggrid, gridOptions=gridOptions, data_return_mode=DataReturnMode.FILTERED_AND_SORTED,
+                        update_mode=GridUpdateMode.MODEL_CHANGED, allow_unsafe_jscode=True, height=350,
+                        width='100%', fit_columns_on_grid_load=True, theme='streamlit',
+                        key="aggrid_accounts"
+                    )
                 
                 selected_rows_df = account_grid_response.get('selected_rows')
 
+                # Хеш-індекс по account_id: позиція рядка в accounts_to_display_df без лінійного пошуку
+                if use_server_pagination or accounts_data_version is None:
+                    account_positions_index = pd.Index(accounts_to_display_df["account_id"])  # сторінка з 10 рядків
+                else:
+                    account_positions_index = get_account_positions_index(accounts_data_version, accounts_to_display_df["account_id"])
+                    # Дешева перевірка, що індекс побудовано саме для цього фрейму (див. get_account_positions_index)
+                    if len(account_positions_index) != len(accounts_to_display_df) or (
+                            len(account_positions_index)
+                            and account_positions_index[-1] != accounts_to_display_df["account_id"].iloc[-1]):
+                        account_positions_index = pd.Index(accounts_to_display_df["account_id"])
+                selected_position = -1
+                selected_id = None
+                if selected_rows_df is not None and not selected_rows_df.empty:
+                    selected_id = str(selected_rows_df.iloc[0].get(columns_to_display_config.get("account_id")))
+                    matched_positions = account_positions_index.get_indexer_for([selected_id])
+                    selected_position = int(matched_positions[0]) if len(matched_positions) else -1
+                    if selected_position >= 0 and accounts_to_display_df["account_id"].iloc[selected_position] != selected_id:
+                        # Спільний індекс не від цього фрейму - будуємо локальний
+                        account_positions_index = pd.Index(accounts_to_display_df["account_id"])
+                        matched_positions = account_positions_index.get_indexer_for([selected_id])
+                        selected_position = int(matched_positions[0]) if len(matched_positions) else -1
+
+                # Передзавантаження позицій для акаунтів поточної сторінки гріда. Сторінку рахуємо по
+                # відсортованих/відфільтрованих у гріді рядках (FILTERED_AND_SORTED): сторінка з вибраним
+                # рядком, або перша, поки нічого не вибрано. Обмеження: номер сторінки ag-grid назад не віддає,
+                # тож перегортання сторінок без вибору рядка передзавантаження не зсуває.
+                grid_account_ids = display_df_aggrid[columns_to_display_config["account_id"]]
+                grid_data = account_grid_response.get('data')
+                if isinstance(grid_data, pd.DataFrame) and columns_to_display_config["account_id"] in grid_data.columns:
+                    grid_account_ids = grid_data[columns_to_display_config["account_id"]]
+                grid_account_ids = grid_account_ids.astype(str).reset_index(drop=True)
+                grid_position = 0
+                if selected_id is not None:
+                    grid_matches = np.flatnonzero(grid_account_ids.to_numpy() == selected_id)
+                    grid_position = int(grid_matches[0]) if len(grid_matches) else 0
+                page_start = (grid_position // grid_page_size) * grid_page_size
+                page_positions = account_positions_index.get_indexer_for(grid_account_ids.iloc[page_start:page_start + grid_page_size])
+                page_accounts_df = accounts_to_display_df.iloc[page_positions[page_positions >= 0]]
+                prefetch_positions_tables([
+                    table_name for table_name in (
+                        DYNAMIC_POSITION_TABLE_NAME_TEMPLATE.format(account_id=account_id, platform_suffix=platform_suffix)
+                        for account_id, platform_suffix in zip(page_accounts_df["account_id"], page_accounts_df["platform_suffix_for_table"])
+                    )
+                    if positions_table_exists(table_name, confirm_miss=False)
+                ])
+
                 if selected_rows_df is not None and not selected_rows_df.empty:
                     first_selected_row_series = selected_rows_df.iloc[0] # Це Series з вибраного рядка AgGrid
                     
@@ -314,18 +1816,15 @@ with tab_accounts:
                     selected_account_id_from_grid = first_selected_row_series.get(columns_to_display_config.get("account_id"))
                     
                     # ВАЖЛИВО: тепер нам потрібен `platform_suffix_for_table` для цього account_id
-                    # Ми повинні знайти відповідний рядок в `accounts_to_display_df` (перед перейменуванням)
-                    original_account_data = accounts_to_display_df[accounts_to_display_df["account_id"] == str(selected_account_id_from_grid)]
-                    
-                    if not original_account_data.empty:
-                        selected_platform_suffix_for_table = original_account_data.iloc[0]["platform_suffix_for_table"]
+                    # Беремо відповідний рядок в `accounts_to_display_df` (перед перейменуванням) за позицією з індексу
+                    if selected_position >= 0:
+                        selected_platform_suffix_for_table = accounts_to_display_df["platform_suffix_for_table"].iloc[selected_position]
                         
                         if selected_account_id_from_grid is not None and selected_platform_suffix_for_table is not None:
                             if (st.session_state.selected_account_id != str(selected_account_id_from_grid) or
                                 st.session_state.selected_account_platform_suffix != selected_platform_suffix_for_table):
                                 st.session_state.selected_account_id = str(selected_account_id_from_grid)
                                 st.session_state.selected_account_platform_suffix = selected_platform_suffix_for_table
-                                st.session_state.selected_account_positions_df = pd.DataFrame()
                                 st.session_state.current_positions_table_name = ""
                                 # st.rerun() # Можна викликати, щоб перейти на вкладку позицій, якщо бажано
                                 st.success(f"Акаунт {st.session_state.selected_account_id} ({st.session_state.selected_account_platform_suffix}) вибрано. Перейдіть на вкладку 'Деталі Позицій'.")
@@ -338,11 +1837,12 @@ with tab_accounts:
                  st.info("Немає акаунтів для відображення після фільтрації по платформі.")
 
 
+    elif use_server_pagination:
+        st.info("Немає акаунтів, що відповідають фільтру.")
     elif 'db_connection_successful' in st.session_state and st.session_state.db_connection_successful:
         st.info(f"Таблиця акаунтів '{ACCOUNTS_TABLE_NAME}' порожня або не вдалося завантажити. Оновлення через {refresh_interval_seconds} сек.")
         st.session_state.selected_account_id = None
         st.session_state.selected_account_platform_suffix = None
-        st.session_state.selected_account_positions_df = pd.DataFrame()
         st.session_state.current_positions_table_name = ""
 
 with tab_positions:
@@ -356,21 +1856,102 @@ with tab_positions:
             platform_suffix=current_platform_suffix # тепер це 'mt5' або 'mt4'
         )
         
+        positions_catalog_df = load_positions_catalog()
+        row_estimate_caption = ""
+        if positions_catalog_df is not None and positions_table_for_account in positions_catalog_df.index:
+            row_estimate_caption = f" (≈ {int(positions_catalog_df.at[positions_table_for_account, 'row_estimate']):,} угод)"
         st.caption(f"Акаунт: {current_account_id} (платформа: {current_platform_suffix}). "
-                   f"Очікувана таблиця позицій: `{positions_table_for_account}`")
+                   f"Очікувана таблиця позицій: `{positions_table_for_account}`{row_estimate_caption}")
+        remember_viewed_positions_table(positions_table_for_account)
 
-        if st.session_state.current_positions_table_name != positions_table_for_account or st.session_state.selected_account_positions_df.empty:
-            with st.spinner(f"Завантаження даних позицій з {positions_table_for_account}..."):
-                st.session_state.selected_account_positions_df = load_data(positions_table_for_account)
+        positions_data_version = table_data_version(table_versions, positions_table_for_account)
+        positions_unchanged = (
+            positions_data_version is not None
+            and st.session_state.get("positions_data_version") == (positions_table_for_account, positions_data_version)
+        )
+        # Сесія тримає лише назву таблиці, сам фрейм - у спільному сховищі (None, якщо його витіснено)
+        positions_df = None
+        if st.session_state.current_positions_table_name == positions_table_for_account:
+            positions_entry = peek_positions_entry(positions_table_for_account, typed=True)
+            positions_df = None if positions_entry is None else positions_entry["df"]
+        if not positions_table_exists(positions_table_for_account):
+            # Каталог знає всі таблиці позицій - пробний запит до неіснуючої таблиці не потрібен
+            st.warning(f"Таблиця '{_qualify_table_name(positions_table_for_account)}' не знайдена в базі даних.")
+            positions_df = pd.DataFrame()
+            st.session_state.current_positions_table_name = positions_table_for_account
+        elif positions_df is None or positions_df.empty:
+            with st.spinner(f"Завантаження даних позицій з {positions_table_for_account}..."), \
+                    rerun_timings.stage("positions_load", current_account_id):
+                positions_df = load_positions_incremental(positions_table_for_account, typed=True)
                 st.session_state.current_positions_table_name = positions_table_for_account
-                if not st.session_state.selected_account_positions_df.empty:
+                if not positions_df.empty:
                      st.success(f"Дані позицій з '{positions_table_for_account}' успішно завантажені.")
-                # Перевірка, чи таблиця існує, вже є в load_data
+                # Перевірка, чи таблиця існує, вже є в load_positions_incremental
+        elif not positions_unchanged:
+            # При автооновленні догружаємо тільки нові угоди (один probe-запит, якщо нічого не змінилось)
+            with rerun_timings.stage("positions_load", current_account_id):
+                positions_df = load_positions_incremental(positions_table_for_account, typed=True)
+        st.session_state.positions_data_version = (positions_table_for_account, positions_data_version)
+
+        # Агрегати беремо лише з того самого запису, що й фрейм (інша сесія могла вже догрузити дельту)
+        positions_entry = peek_positions_entry(positions_table_for_account, typed=True)
+        positions_rollups = positions_entry.get("rollups") if positions_entry is not None and positions_entry["df"] is positions_df else None
         
-        display_position_charts(st.session_state.selected_account_positions_df, st.session_state.current_positions_table_name, current_account_id)
+        display_position_charts(positions_df, st.session_state.current_positions_table_name,
+                                current_account_id, data_version=positions_data_version, rollups=positions_rollups)
     else:
         st.info("Будь ласка, оберіть акаунт на вкладці 'Акаунти', щоб побачити деталі позицій.")
 
+    with st.expander("⬇️ Експорт історії угод"):
+        display_positions_export(st.session_state.current_positions_table_name or None)
+
+with tab_comparison:
+    st.header("Порівняння акаунтів")
+    display_accounts_comparison()
+
 # ---- Підвал ----
 st.markdown("---")
 st.markdown("© 2024 Ваш Торговий Дашборд.")
+
+# ---- МЕТРИКИ RERUN ----
+instrumentation.REGISTRY.observe_rerun(rerun_timings)
+if METRICS_FILES_ENABLED:
+    try:
+        instrumentation.append_json_log(METRICS_DIR / "stages.jsonl", rerun_timings.records(),
+                                        max_bytes=METRICS_LOG_MAX_BYTES, backup_count=METRICS_LOG_BACKUPS)
+        instrumentation.write_prometheus_file(METRICS_DIR / "dashboard.prom", instrumentation.REGISTRY)
+    except OSError as e:
+        st.sidebar.caption(f"Не вдалося записати метрики: {e}")
+
+if show_debug_panel:
+    with st.sidebar:
+        st.subheader("Продуктивність (debug)")
+        st.caption("Етапи цього оновлення")
+        st.dataframe(
+            pd.DataFrame(rerun_timings.stages, columns=["Етап", "Акаунт", "Секунд"]),
+            hide_index=True, use_container_width=True
+        )
+        stage_percentiles = instrumentation.REGISTRY.stage_percentiles()
+        if stage_percentiles:
+            st.caption("p50 / p95 по процесу (останні заміри)")
+            st.dataframe(
+                pd.DataFrame.from_dict(stage_percentiles, orient="index").rename(
+                    columns={"p50": "p50, с", "p95": "p95, с", "samples": "Замірів"}
+                ),
+                use_container_width=True
+            )
+        table_stats = instrumentation.REGISTRY.table_stats()
+        if table_stats:
+            st.caption("Кеш таблиць")
+            st.dataframe(
+                pd.DataFrame.from_dict(table_stats, orient="index").rename(
+                    columns={"hits": "Влучань", "misses": "Промахів", "rows": "Рядків", "bytes": "Байт"}
+                ),
+                use_container_width=True
+            )
+        store_stats = get_positions_cache()["entries"].stats()
+        st.caption(
+            f"Сховище фреймів: {store_stats['frames']} фреймів, "
+            f"{store_stats['bytes'] / 1024 / 1024:.1f} з {store_stats['max_bytes'] / 1024 / 1024:.0f} МБ, "
+            f"витіснень: {store_stats['evictions']}"
+        )
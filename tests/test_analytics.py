@@ -0,0 +1,116 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import analytics  # noqa: E402
+
+
+def _cached_positions() -> pd.DataFrame:
+    # Як після повного завантаження в untyped-режимі: NULL time_close першими, далі за часом
+    cached_df = pd.DataFrame({
+        "ticket": [1, 2, 3],
+        "time_close": [None, "2024-01-01 10:00:00", "2024-01-01 11:00:00"],
+        "net_profit_db": [5.0, 10.0, -3.0],
+    })
+    cached_df["cumulative_profit"] = analytics.equity_curve(cached_df["net_profit_db"])
+    return cached_df
+
+
+def test_merge_trades_delta_keeps_rows_without_watermark():
+    cached_df = _cached_positions()
+    # Дельта з "time_close" >= watermark: граничний рядок заново + нова угода, NULL-рядків немає
+    delta_df = pd.DataFrame({
+        "ticket": [3, 4],
+        "time_close": ["2024-01-01 11:00:00", "2024-01-01 12:00:00"],
+        "net_profit_db": [-3.0, 7.0],
+    })
+
+    merged_df = analytics.merge_trades_delta(cached_df, delta_df, "time_close", "2024-01-01 11:00:00")
+
+    assert merged_df["ticket"].tolist() == [1, 2, 3, 4]
+    np.testing.assert_allclose(merged_df["cumulative_profit"], analytics.equity_curve(merged_df["net_profit_db"]))
+
+
+def test_merge_trades_delta_uses_custom_append():
+    cached_df = _cached_positions()
+    delta_df = pd.DataFrame({"ticket": [4], "time_close": ["2024-01-01 12:00:00"], "net_profit_db": [1.0]})
+
+    merged_df = analytics.merge_trades_delta(
+        cached_df, delta_df, "time_close", "2024-01-01 12:00:00",
+        append=lambda kept_df, fresh_df: pd.concat([kept_df, fresh_df], ignore_index=True).assign(appended=True)
+    )
+
+    assert merged_df["appended"].all()
+    assert merged_df["cumulative_profit"].iloc[-1] == 13.0
+
+
+def test_clean_trades_recomputes_cumulative_profit_after_cleaning():
+    # Текстовий time_close: у сирому порядку "2024-01-01 9:00" йде після "10:00", а рядок без часу випадає
+    positions_df = pd.DataFrame({
+        "time_close": ["2024-01-01 10:00:00", "2024-01-01 9:00:00", None],
+        "net_profit_db": [10.0, -4.0, 100.0],
+        "change_balance_acc": [1000.0, 1000.0, 1000.0],
+    })
+    positions_df["cumulative_profit"] = analytics.equity_curve(positions_df["net_profit_db"])
+
+    cleaned_df, time_kind = analytics.clean_trades(positions_df)
+
+    assert time_kind == analytics.TIME_KIND_DATETIME
+    assert cleaned_df["net_profit_db"].tolist() == [-4.0, 10.0]
+    assert cleaned_df["cumulative_profit"].tolist() == [-4.0, 6.0]
+
+
+def _trade_series(n_trades: int, seed: int = 7) -> tuple:
+    # Відсортовані часи закриття з кількома угодами в одну й ту саму мить (як граничні рядки watermark)
+    rng = np.random.default_rng(seed)
+    start_ns = pd.Timestamp("2024-01-03 05:30").value
+    times_ns = np.sort(start_ns + rng.integers(0, 40 * 24, n_trades) * (analytics.NS_PER_HOUR // 2))
+    profits = rng.normal(0.0, 10.0, n_trades).round(2)
+    balances = 1000.0 + np.cumsum(profits)
+    return times_ns, profits, balances, analytics.equity_curve(profits)
+
+
+def test_extend_rollup_matches_full_rollup():
+    times_ns, profits, balances, equity = _trade_series(500)
+    for resolution in analytics.ROLLUP_RESOLUTIONS:
+        for cached_count in (1, 137, 250, 499):
+            # Кеш - угоди до watermark включно; дельта починається з watermark (граничні угоди беруться заново)
+            watermark_ns = times_ns[cached_count - 1]
+            cached = np.searchsorted(times_ns, watermark_ns, side='right')
+            cached_rollup = analytics.rollup_trades(
+                times_ns[:cached], profits[:cached], balances[:cached], equity[:cached], resolution
+            )
+
+            extended = analytics.extend_rollup(cached_rollup, times_ns, profits, balances, equity, resolution, watermark_ns)
+
+            pd.testing.assert_frame_equal(
+                extended, analytics.rollup_trades(times_ns, profits, balances, equity, resolution), check_exact=True
+            )
+
+
+def test_choose_rollup_resolution_by_window():
+    times_ns, profits, balances, equity = _trade_series(2000)
+    rollups = {
+        resolution: analytics.rollup_trades(times_ns, profits, balances, equity, resolution)
+        for resolution in analytics.ROLLUP_RESOLUTIONS
+    }
+    day_ns = 24 * analytics.NS_PER_HOUR
+    first_ns, last_ns = int(times_ns[0]), int(times_ns[-1])
+
+    # Вузьке вікно: сирих угод не більше max_points
+    resolution, n_points = analytics.choose_rollup_resolution(times_ns, rollups, first_ns, first_ns + day_ns, max_points=200)
+    assert resolution is None
+    assert n_points == np.count_nonzero(times_ns <= first_ns + day_ns)
+
+    # Уся історія (40 днів, ~960 годин): угод і годин забагато, днів - якраз
+    resolution, n_points = analytics.choose_rollup_resolution(times_ns, rollups, first_ns, last_ns, max_points=200)
+    assert resolution == "day"
+    assert n_points == len(rollups["day"])
+
+    # Не вміщається жоден рівень - найгрубший
+    resolution, n_points = analytics.choose_rollup_resolution(times_ns, rollups, first_ns, last_ns, max_points=3)
+    assert resolution == "week"
+    assert n_points == len(rollups["week"])
@@ -0,0 +1,52 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import frame_store  # noqa: E402
+
+
+def _compact_positions(n_rows: int) -> pd.DataFrame:
+    positions_df = pd.DataFrame({
+        "ticket": np.arange(n_rows, dtype='int64'),
+        "symbol": np.array(["EURUSD", "XAUUSD"] * (n_rows // 2), dtype=object),
+        "volume": np.array([0.5, 1.0] * (n_rows // 2)),
+        "net_profit_db": np.round(np.linspace(-5, 5, n_rows), 2),
+    })
+    return frame_store.compact_frame(positions_df, category_columns=("symbol",), keep_columns=("ticket",))
+
+
+def test_append_compact_keeps_compact_dtypes():
+    compact_df = _compact_positions(1000)
+    delta_df = pd.DataFrame({
+        "ticket": np.array([1000, 1001], dtype='int64'),
+        "symbol": np.array(["EURUSD", "BTCUSD"], dtype=object),
+        "volume": [2.0, 0.25],
+        "net_profit_db": [0.01, -0.02],
+    })
+
+    merged_df = frame_store.append_compact(compact_df, delta_df, category_columns=("symbol",), keep_columns=("ticket",))
+
+    assert len(merged_df) == 1002
+    assert isinstance(merged_df["symbol"].dtype, pd.CategoricalDtype)
+    assert merged_df["symbol"].tolist()[-2:] == ["EURUSD", "BTCUSD"]
+    assert merged_df["volume"].dtype == 'float32'
+    assert merged_df["net_profit_db"].dtype == 'float64'
+    assert merged_df["ticket"].tolist()[-2:] == [1000, 1001]
+
+
+def test_append_compact_widens_when_delta_does_not_fit():
+    compact_df = _compact_positions(10)
+    delta_df = pd.DataFrame({
+        "ticket": np.array([10], dtype='int64'),
+        "symbol": np.array(["EURUSD"], dtype=object),
+        "volume": [0.1],  # у float32 не вміщається точно
+        "net_profit_db": [1.0],
+    })
+
+    merged_df = frame_store.append_compact(compact_df, delta_df, category_columns=("symbol",))
+
+    assert merged_df["volume"].dtype == 'float64'
+    assert merged_df["volume"].iloc[-1] == 0.1